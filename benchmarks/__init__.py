@@ -0,0 +1 @@
+""" Performance benchmarks (run modules by `python -m benchmarks.<NAME>`) """
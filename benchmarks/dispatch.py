@@ -0,0 +1,84 @@
+""" Benchmark of event dispatching to many registered workers """
+from timeit import timeit
+from typing import List
+
+from botlet.bot import _EventRouter
+from botlet.plugins import AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Command, CommandRegistry, Event, StatusEventData
+
+
+# Number of registered workers per kind
+WORKERS_PER_KIND = 20
+
+
+# Number of dispatched events per measurement
+EVENTS_NUMBER = 10000
+
+
+class _CommandPlugin(AbstractPlugin):
+    EVENT_DATA_TYPES = ()
+
+    def apply_event(self, event: Event):
+        # Broadcast case: parse command by plugin itself
+        if isinstance(event.data, ChatCommandEventData) and event.data.command.split(maxsplit=1)[0] == self.name:
+            pass
+
+    def get_commands(self) -> List[Command]:
+        return [Command(self.name, lambda _event, _args: None, ('ARG',))]
+
+
+class _ChatPlugin(AbstractPlugin):
+    EVENT_DATA_TYPES = (ChatOutputEventData,)
+
+    def apply_event(self, event: Event):
+        if isinstance(event.data, ChatOutputEventData) and event.data.target_publisher in (None, self.name):
+            pass
+
+
+class _TimerPlugin(AbstractPlugin):
+    EVENT_DATA_TYPES = ()
+
+    def apply_event(self, event: Event):
+        pass
+
+
+def _create_workers() -> List[AbstractPlugin]:
+    return [
+        worker_class('{}_{}'.format(worker_class.__name__, i))
+        for worker_class in (_CommandPlugin, _ChatPlugin, _TimerPlugin)
+        for i in range(WORKERS_PER_KIND)
+    ]
+
+
+def main():
+    """ Compare broadcast to all workers with routed dispatch """
+    workers = _create_workers()
+    router = _EventRouter(workers, CommandRegistry())
+    timed_router = _EventRouter(workers, CommandRegistry(), True)
+    events = [
+        Event('chat', ChatCommandEventData('_CommandPlugin_7 foo', 42)),
+        Event('_CommandPlugin_7', ChatOutputEventData('Foo bar', 'chat', 42)),
+        Event('timer', StatusEventData('Alive'))
+    ]
+    def broadcast():
+        for event in events:
+            for worker in workers:
+                if worker.name != event.publisher:
+                    worker.apply_event(event)
+    def route():
+        for event in events:
+            router.dispatch(event)
+    def route_timed():
+        for event in events:
+            timed_router.dispatch(event)
+    number = EVENTS_NUMBER // len(events)
+    broadcast_time = timeit(broadcast, number=number)
+    route_time = timeit(route, number=number)
+    route_timed_time = timeit(route_timed, number=number)
+    print('Workers: {}, events: {}'.format(len(workers), number * len(events)))
+    print('Broadcast: {:.3f}s ({:.2f}us/event)'.format(broadcast_time, broadcast_time / (number * len(events)) * 1e6))
+    print('Routed: {:.3f}s ({:.2f}us/event)'.format(route_time, route_time / (number * len(events)) * 1e6))
+    print('Routed with metrics: {:.3f}s ({:.2f}us/event)'.format(route_timed_time, route_timed_time / (number * len(events)) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
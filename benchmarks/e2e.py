@@ -0,0 +1,217 @@
+""" End-to-end benchmark of bot commands with fake chat clients, local git remote and local anisearch-like website """
+from argparse import ArgumentParser
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dump as json_dump
+from os import environ
+from os.path import join as path_join
+from platform import python_version
+from resource import RUSAGE_SELF, getrusage
+from subprocess import run as process_run
+from threading import Condition, Event as ThreadEvent, Thread, active_count
+from time import perf_counter, sleep
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from botlet import __version__ as version
+from botlet.bot import run as bot_run
+from botlet.plugins import ChatCommandEventData, EventData, chat, webcrawl
+from botlet.utils import HttpFetcher, SafeTemporaryDirectory
+
+
+# Commands sent round-robin
+COMMANDS = ('help', 'git local main', 'anime_birthdays')
+
+
+# Number of characters on birthday page
+CHARACTERS_NUMBER = 20
+
+
+class _Replies:
+    """ Reply times by channel of command, awaitable by senders """
+    def __init__(self):
+        self._times: Dict[str, float] = {}
+        self._changed = Condition()
+
+    def add(self, channel_id: Union[str,int,None]):
+        with self._changed:
+            self._times.setdefault(str(channel_id), perf_counter())
+            self._changed.notify_all()
+
+    def wait(self, channel_id: str, timeout: float) -> Optional[float]:
+        with self._changed:
+            self._changed.wait_for(lambda: channel_id in self._times, timeout)
+            return self._times.get(channel_id)
+
+
+# Shared by fake clients of bot & harness
+_REPLIES = _Replies()
+_CLIENTS: Dict[str, '_FakeChatClient'] = {}
+
+
+class _FakeChatClient:
+    """ In-process replacement of chat clients: commands get injected, replies recorded """
+    def __init__(self, name: str, stopped: ThreadEvent, message_queue: Any, publish_event_data: Callable[[EventData], None]):
+        self._stopped = stopped
+        self._message_queue = message_queue
+        self.publish_event_data = publish_event_data
+        _CLIENTS[name] = self
+
+    async def run(self):
+        """ Record replies until stopped """
+        while not self._stopped.is_set():
+            for message in await self._message_queue.get_all():
+                _REPLIES.add(message.channel_id)
+
+
+class _FakeDiscordClient(_FakeChatClient):
+    def __init__(self, _loop: Any, stopped: ThreadEvent, message_queue: Any, _channel_id: int, publish_event_data: Callable[[EventData], None]):
+        super().__init__('discord', stopped, message_queue, publish_event_data)
+
+    async def start(self, _token: str):
+        """ Replaces login """
+        await self.run()
+
+
+class _FakeSlackClient(_FakeChatClient):
+    def __init__(self, _loop: Any, _token: str, stopped: ThreadEvent, message_queue: Any, _channel_id: str, publish_event_data: Callable[[EventData], None]):
+        super().__init__('slack', stopped, message_queue, publish_event_data)
+
+    async def start(self):
+        """ Replaces connect """
+        await self.run()
+
+
+class _LocalFetcher(HttpFetcher):
+    """ Fetcher redirecting anisearch to local server """
+    def __init__(self, base_url: str):
+        super().__init__(timeout=10)
+        self._base_url = base_url
+
+    def iter_chunks(self, url: str, timeout: Optional[float] = None, chunk_size: int = 16384):
+        return super().iter_chunks(url.replace('http://www.anisearch.com/', self._base_url), timeout, chunk_size)
+
+
+def _start_anisearch_server() -> ThreadingHTTPServer:
+    today = date.today()
+    padding = '<div class="filler">{}</div>'.format('x' * 200) * 200
+    birthdays_page = '<html><body>{}<section id="day-{}">{}</section>{}</body></html>'.format(
+        padding, today.day,
+        ''.join('<a data-title="Character: character {0}" href="character/{0}">Character</a><span>{1}\u2003❤</span>'.format(i, i * 7) for i in range(CHARACTERS_NUMBER)),
+        padding
+    ).encode('utf-8')
+    character_page = '<html><body><section><a data-title="Anime: Benchmark">Anime</a></section>{}</body></html>'.format(padding).encode('utf-8')
+    class Handler(BaseHTTPRequestHandler):
+        """ Anisearch-like pages """
+        protocol_version = 'HTTP/1.1'
+        def do_GET(self):   # pylint: disable=C0103
+            """ Handle GET request """
+            body = birthdays_page if self.path.startswith('/character/birthdays') else character_page
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):   # pylint: disable=W0221
+            pass
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    server.handle_error = lambda *_args: None   # Crawler closes connections after needed data
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _create_git_remote(path: str):
+    git_env = dict(environ, GIT_AUTHOR_NAME='Bench', GIT_AUTHOR_EMAIL='bench@bench', GIT_COMMITTER_NAME='Bench', GIT_COMMITTER_EMAIL='bench@bench')
+    process_run(['git', 'init', '-q', '-b', 'main', path], env=git_env, check=True)
+    for i in range(10):
+        process_run(['git', 'commit', '-q', '--allow-empty', '-m', 'Commit {}'.format(i)], cwd=path, env=git_env, check=True)
+
+
+def _send_commands(name: str, commands_number: int, concurrency: int, timeout: float) -> Tuple[List[float], int]:
+    # Closed loop: every sender waits for reply before next command
+    latencies: List[float] = []
+    failures = [0]
+    clients = [_CLIENTS['discord'], _CLIENTS['slack']]
+    def send(sender: int):
+        for index in range(sender, commands_number, concurrency):
+            channel_id = '{}_{}'.format(name, index)
+            start = perf_counter()
+            clients[index % len(clients)].publish_event_data(ChatCommandEventData(COMMANDS[index % len(COMMANDS)], channel_id))
+            reply_time = _REPLIES.wait(channel_id, timeout)
+            if reply_time is None:
+                failures[0] += 1
+            else:
+                latencies.append(reply_time - start)
+    senders = [Thread(target=send, args=(sender,)) for sender in range(concurrency)]
+    for sender in senders:
+        sender.start()
+    for sender in senders:
+        sender.join()
+    return latencies, failures[0]
+
+
+def _get_percentile(values: List[float], percentile: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * percentile / 100), len(ordered) - 1)] if ordered else 0.0
+
+
+def main():
+    """ Run bot with fake backends, measure commands throughput & latency, save results as JSON """
+    parser = ArgumentParser(description='End-to-end benchmark of bot commands.')
+    parser.add_argument('-n', '--commands', type=int, default=3000, help='number of commands to send')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='number of commands waiting for reply at once')
+    parser.add_argument('-w', '--event-workers', type=int, default=0, help='bot event workers (threaded runtime)')
+    parser.add_argument('-o', '--output', default='e2e_results.json', help='file to save results')
+    args = parser.parse_args()
+    # Replace external backends
+    chat._DiscordClient = _FakeDiscordClient    # pylint: disable=W0212
+    chat._SlackClient = _FakeSlackClient    # pylint: disable=W0212
+    server = _start_anisearch_server()
+    webcrawl._CRAWLER = webcrawl._Crawler(_LocalFetcher('http://127.0.0.1:{}/'.format(server.server_address[1])), webcrawl._CrawlSettings(host_delay=0))  # pylint: disable=W0212
+    with SafeTemporaryDirectory(prefix='botlet_bench_') as dir_path:
+        _create_git_remote(path_join(dir_path, 'remote'))
+        config = {
+            'general': {'event_workers': str(args.event_workers)},
+            'plugin.git': {'cache_dir': path_join(dir_path, 'mirrors'), 'local': path_join(dir_path, 'remote')},
+            'plugin.anime_birthdays': {'cache_file': path_join(dir_path, 'anime_birthdays.json'), 'index_file': path_join(dir_path, 'anime_index.json')}
+        }
+        env = {'DISCORD_TOKEN': 'fake', 'DISCORD_CHANNEL_ID': '1', 'SLACK_TOKEN': 'fake', 'SLACK_CHANNEL_ID': '1'}
+        stop_event = ThreadEvent()
+        bot_thread = Thread(target=bot_run, args=(config, env, stop_event))
+        bot_thread.start()
+        try:
+            while len(_CLIENTS) < 2:
+                sleep(0.01)
+            # Warm up caches & connections, then measure
+            _send_commands('warmup', len(COMMANDS), 1, 30)
+            threads_before = active_count()
+            memory_before = getrusage(RUSAGE_SELF).ru_maxrss
+            start = perf_counter()
+            latencies, failures = _send_commands('run', args.commands, args.concurrency, 30)
+            duration = perf_counter() - start
+            results = {
+                'version': version,
+                'python': python_version(),
+                'time': datetime.now().isoformat(timespec='seconds'),
+                'commands': args.commands,
+                'concurrency': args.concurrency,
+                'event_workers': args.event_workers,
+                'failures': failures,
+                'commands_per_second': round(len(latencies) / duration, 1),
+                'latency_p50_ms': round(_get_percentile(latencies, 50) * 1e3, 3),
+                'latency_p99_ms': round(_get_percentile(latencies, 99) * 1e3, 3),
+                'max_rss_growth_kb': getrusage(RUSAGE_SELF).ru_maxrss - memory_before,
+                'threads_before': threads_before,
+                'threads_after': active_count()
+            }
+        finally:
+            stop_event.set()
+            bot_thread.join()
+            server.shutdown()
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json_dump(results, file, indent=2)
+    print('\n'.join('{}: {}'.format(key, value) for key, value in results.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+""" Benchmark of git commits queries by processes per query or long-lived object reader """
+import subprocess
+from os import environ
+from os.path import join as path_join
+from time import perf_counter
+from typing import Callable, Tuple
+
+from botlet.plugins.git import _GitMirrors
+from botlet.utils import SafeTemporaryDirectory
+
+
+# Number of commits queries per measurement
+QUERIES_NUMBER = 200
+
+
+def _count_forks(func: Callable[[], None]) -> Tuple[float, int]:
+    # Count started processes by hooking process creation of standard library
+    forks = [0]
+    execute_child = subprocess.Popen._execute_child # pylint: disable=W0212
+    def counted_execute_child(*args, **kwargs):
+        forks[0] += 1
+        return execute_child(*args, **kwargs)
+    subprocess.Popen._execute_child = counted_execute_child # pylint: disable=W0212
+    try:
+        start = perf_counter()
+        func()
+        return perf_counter() - start, forks[0]
+    finally:
+        subprocess.Popen._execute_child = execute_child # pylint: disable=W0212
+
+
+def main():
+    """ Compare fetch & log processes per query with object reader (fetching per query or by ttl) """
+    with SafeTemporaryDirectory(prefix='botlet_bench_') as dir_path:
+        repository = path_join(dir_path, 'remote')
+        git_env = dict(environ, GIT_AUTHOR_NAME='Bench', GIT_AUTHOR_EMAIL='bench@bench', GIT_COMMITTER_NAME='Bench', GIT_COMMITTER_EMAIL='bench@bench')
+        subprocess.run(['git', 'init', '-q', '-b', 'main', repository], env=git_env, check=True)
+        for i in range(10):
+            subprocess.run(['git', 'commit', '-q', '--allow-empty', '-m', 'Commit {}'.format(i)], cwd=repository, env=git_env, check=True)
+        def query_processes():
+            mirror_path = path_join(dir_path, 'processes.git')
+            subprocess.run(['git', 'init', '--bare', '-q', mirror_path], check=True)
+            for _ in range(QUERIES_NUMBER):
+                subprocess.run(['git', 'fetch', '-q', '--depth=3', '--filter=blob:none', repository, '+refs/heads/main:refs/heads/main'], cwd=mirror_path, stderr=subprocess.DEVNULL, check=True)
+                subprocess.run(['git', 'log', '-n3', '--no-decorate', '--format=[%h] %s (by %cn, %cr)', 'refs/heads/main'], cwd=mirror_path, capture_output=True, check=True)
+        def query_mirrors(fetch_ttl: float) -> Callable[[], None]:
+            def query():
+                mirrors = _GitMirrors(path_join(dir_path, 'mirrors_{}'.format(fetch_ttl)), 1 << 30, fetch_ttl=fetch_ttl)
+                try:
+                    for _ in range(QUERIES_NUMBER):
+                        mirrors.get_branch_commits(repository, 'main')
+                finally:
+                    mirrors.close()
+            return query
+        print('Queries: {}'.format(QUERIES_NUMBER))
+        for name, query in (
+                ('Fetch & log processes', query_processes),
+                ('Fetch process & object reader', query_mirrors(0)),
+                ('Fetch by ttl & object reader', query_mirrors(60))
+            ):
+            duration, forks = _count_forks(query)
+            print('{}: {:.3f}s ({:.2f}ms/query), {} processes'.format(name, duration, duration / QUERIES_NUMBER * 1e3, forks))
+
+
+if __name__ == '__main__':
+    main()
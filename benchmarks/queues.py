@@ -0,0 +1,74 @@
+""" Benchmark of bot event queue throughput between threads """
+from queue import Empty, Full, Queue
+from threading import Thread
+from time import perf_counter
+from typing import Callable, Optional
+
+from botlet.utils import SafeQueue
+
+
+# Number of transferred items per measurement
+ITEMS_NUMBER = 200000
+
+
+# Capacity of queues
+QUEUE_SIZE = 1024
+
+
+class _LegacySafeQueue:
+    """ Previous implementation by standard queue """
+    def __init__(self, maxsize: int):
+        self._queue = Queue(maxsize)
+
+    def get(self, timeout: Optional[float] = None) -> Optional[int]:
+        try:
+            return self._queue.get_nowait() if timeout is None else self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def put(self, item: int) -> bool:
+        try:
+            self._queue.put_nowait(item)
+            return True
+        except Full:
+            return False
+
+
+def _measure(put: Callable[[int], bool], consume: Callable[[], int]) -> float:
+    # Producer thread retries on full queue, consumer on main thread
+    def produce():
+        for item in range(ITEMS_NUMBER):
+            while not put(item):
+                pass
+    thread = Thread(target=produce)
+    start = perf_counter()
+    thread.start()
+    received = 0
+    while received < ITEMS_NUMBER:
+        received += consume()
+    thread.join()
+    return perf_counter() - start
+
+
+def main():
+    """ Compare single gets of previous queue with single & batch gets of current queue """
+    legacy_queue = _LegacySafeQueue(QUEUE_SIZE)
+    queue = SafeQueue[int](QUEUE_SIZE)
+    def get_legacy() -> int:
+        return 0 if legacy_queue.get(1) is None else 1
+    def get_single() -> int:
+        return 0 if queue.get(1) is None else 1
+    def get_batch() -> int:
+        return len(queue.get_batch(64, 1))
+    print('Items: {}, queue size: {}'.format(ITEMS_NUMBER, QUEUE_SIZE))
+    for name, put, consume in (
+            ('Legacy (queue.Queue)', legacy_queue.put, get_legacy),
+            ('Deque single get', queue.put, get_single),
+            ('Deque batch get', queue.put, get_batch)
+        ):
+        duration = _measure(put, consume)
+        print('{}: {:.3f}s ({:.0f} items/s)'.format(name, duration, ITEMS_NUMBER / duration))
+
+
+if __name__ == '__main__':
+    main()
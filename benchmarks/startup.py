@@ -0,0 +1,49 @@
+""" Benchmark of bot cold start (fresh interpreters) """
+from subprocess import run as process_run
+from sys import executable
+from time import perf_counter
+
+
+# Number of started interpreters per measurement
+STARTS_NUMBER = 10
+
+
+# Bot run without configuration, stopped at once
+_RUN_CODE = '''
+from threading import Event
+from botlet.bot import run
+stop_event = Event()
+stop_event.set()
+run({}, {}, stop_event)
+'''
+
+
+# Previous plugin loading: import of all plugin modules
+_SCAN_CODE = '''
+from importlib import import_module
+from pkgutil import iter_modules
+from botlet import plugins
+for module_info in iter_modules(plugins.__path__):
+    import_module('.' + module_info.name, plugins.__package__)
+''' + _RUN_CODE
+
+
+def _measure(code: str) -> float:
+    start = perf_counter()
+    for _ in range(STARTS_NUMBER):
+        process_run([executable, '-c', code], check=True)
+    return (perf_counter() - start) / STARTS_NUMBER
+
+
+def main():
+    """ Compare scan of plugin package with loading by manifest """
+    interpreter_time = _measure('pass')
+    scan_time = _measure(_SCAN_CODE)
+    manifest_time = _measure(_RUN_CODE)
+    print('Starts: {}, interpreter only: {:.0f}ms'.format(STARTS_NUMBER, interpreter_time * 1e3))
+    print('Scanned plugins: {:.0f}ms'.format(scan_time * 1e3))
+    print('Manifest plugins: {:.0f}ms'.format(manifest_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
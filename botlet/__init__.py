@@ -1,5 +1,5 @@
 """ Top package of module """
-from .bot import run as bot_run
+from .bot import run as bot_run, run_async as bot_run_async
 
 
 __version__ = '1.0'
@@ -1,13 +1,27 @@
 """ Bot logic """
+from asyncio import Queue as AsyncQueue, QueueFull, TimeoutError as AsyncTimeoutError, get_running_loop, wait_for
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from importlib import import_module
+try:
+    from importlib.metadata import entry_points
+except ImportError: # Python < 3.8
+    entry_points = None
 from logging import getLogger
-from pkgutil import iter_modules
 from threading import Event as ThreadEvent
-from typing import Callable, Dict, List, Optional
+from time import perf_counter, sleep
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 
-from . import plugins
-from .plugins import AbstractPlugin, Event
-from .utils import SafeQueue
+from .plugins import PLUGIN_MODULES, AbstractAsyncPlugin, AbstractPlugin, ChatCommandEventData, ChatOutputEventData, CommandRegistry, Event, EventData, StatusEventData
+from .utils import METRICS, HistogramChild, MetricsServer, OverflowPolicy, SafeQueue, ShardedPool, Watermarks
+
+
+# Metrics of event processing
+_EVENTS = METRICS.counter('botlet_events_total', 'Dispatched events', ('publisher', 'event_type'))
+_APPLY_SECONDS = METRICS.histogram('botlet_event_apply_seconds', 'Duration of event application by plugin', ('plugin', 'event_type'))
+_QUEUE_DEPTH = METRICS.gauge('botlet_queue_depth', 'Number of queued items', ('queue',))
+_QUEUE_DROPPED = METRICS.counter('botlet_queue_dropped_total', 'Items dropped by full queue', ('queue',))
+_EVENTS_SHED = METRICS.counter('botlet_events_shed_total', 'Status events dropped by congested bot event queue', ('publisher',))
 
 
 def run(config: Dict[str,Dict[str,str]], env: Dict[str, str], stop_event: Optional[ThreadEvent] = None):
@@ -16,39 +30,240 @@ def run(config: Dict[str,Dict[str,str]], env: Dict[str, str], stop_event: Option
     log = getLogger(__name__)
     log.debug('Configuration: %s', config)
     log.debug('Environment (keys-only): %s', list(env.keys()))
-    # Setup event queue
-    event_queue = SafeQueue[Event](1024)
+    # Setup event queue (or pool of queues by shards)
+    general_config = config.get('general', {})
+    event_queue, event_pool, publish_event = _create_event_queues(general_config)
+    untrack_queues = _track_event_queues(event_queue, event_pool)
+    metrics_server = _start_metrics_server(general_config)
+    # Register workers by plugins and process their events
+    workers: List[AbstractPlugin] = []
+    try:
+        _register_plugins(workers, publish_event, config, env)
+        if workers:
+            router = _EventRouter(workers, CommandRegistry(publish_event), metrics_server is not None)
+            if event_pool:
+                event_pool.start(router.dispatch)
+                _wait_stop(stop_event)
+            else:
+                _process_events(router, event_queue, stop_event)
+    finally:
+        # Terminate event processing & workers
+        if event_pool:
+            event_pool.close()
+        _close_workers(workers)
+        if metrics_server:
+            metrics_server.close()
+        untrack_queues()
+
+
+def _create_event_queues(general_config: Dict[str, str]) -> Tuple[SafeQueue[Event], Optional[ShardedPool[Event]], Callable[[Event], None]]:
+    # Event queue, pool of queues by shards if configured & publish function filling them
+    log = getLogger(__name__)
+    event_queue_size = int(general_config.get('event_queue_size') or 1024)
+    event_workers = int(general_config.get('event_workers') or 0)
+    event_overflow = OverflowPolicy(general_config.get('event_overflow') or OverflowPolicy.DROP_NEWEST.value)
+    if event_overflow == OverflowPolicy.BLOCK:
+        # Dispatching threads publish replies too, so waiting for space would stall the only consumers
+        raise ValueError('Bot event queue does not support overflow policy "block"!')
+    event_key = _get_coalesce_key if event_overflow == OverflowPolicy.COALESCE else None
+    congested = ThreadEvent()
+    def on_watermark(is_congested: bool):
+        if is_congested:
+            congested.set()
+            log.warning('Bot event queue is congested, shedding status events! Size: %d', len(event_queue))
+        else:
+            congested.clear()
+            log.info('Bot event queue recovered.')
+    event_queue = SafeQueue[Event](event_queue_size, event_overflow, None, event_key, Watermarks(event_queue_size * 3 // 4, event_queue_size // 4, on_watermark))
+    event_pool = ShardedPool[Event](event_workers, event_queue_size, event_overflow, None, event_key) if event_workers > 0 else None
     def publish_event(event: Event):
-        if not event_queue.put(event):
+        if congested.is_set() and isinstance(event.data, StatusEventData):
+            _EVENTS_SHED.inc(event.publisher)   # Backpressure: informative events give way to commands & replies
+        elif event_pool:
+            if not event_pool.put(_get_shard_key(event), event):
+                log.warning('Bot event shard queue is full! Depths: %s, event: %s', event_pool.get_depths(), event)
+        elif not event_queue.put(event):
+            log.warning('Bot event queue is full! Dropped: %d, event: %s', event_queue.dropped, event)
+    return event_queue, event_pool, publish_event
+
+
+async def run_async(config: Dict[str,Dict[str,str]], env: Dict[str, str], stop_event: Optional[ThreadEvent] = None):
+    """ Bot main loop on running event loop, shared with asynchronous plugins """
+    # Give input feedback
+    log = getLogger(__name__)
+    log.debug('Configuration: %s', config)
+    log.debug('Environment (keys-only): %s', list(env.keys()))
+    # Bound threads for blocking work
+    general_config = config.get('general', {})
+    loop = get_running_loop()
+    executor = ThreadPoolExecutor(int(general_config.get('executor_workers') or 8), 'botlet_executor')
+    loop.set_default_executor(executor)
+    # Setup event queue, filled thread-safe
+    event_queue = AsyncQueue(int(general_config.get('event_queue_size') or 1024))
+    def put_event(event: Event):
+        try:
+            event_queue.put_nowait(event)
+        except QueueFull:
+            _QUEUE_DROPPED.inc('bot')
             log.warning('Bot event queue is full! Event: %s', event)
+    def publish_event(event: Event):
+        try:
+            loop.call_soon_threadsafe(put_event, event)
+        except RuntimeError:
+            log.warning('Bot event loop is closed! Event: %s', event)
+    _QUEUE_DEPTH.track(event_queue.qsize, 'bot')
+    metrics_server = _start_metrics_server(general_config)
     # Register workers by plugins and process their events
     workers: List[AbstractPlugin] = []
     try:
         _register_plugins(workers, publish_event, config, env)
-        _process_events(workers, event_queue, stop_event)
+        if workers:
+            router = _EventRouter(workers, CommandRegistry(publish_event), metrics_server is not None)
+            while not (stop_event and stop_event.is_set()):
+                try:
+                    router.dispatch(await wait_for(event_queue.get(), 1))   # Timeout required to check stop event
+                except AsyncTimeoutError:
+                    pass
     finally:
         # Terminate workers
+        _close_workers(workers)
         for worker in workers:
+            if isinstance(worker, AbstractAsyncPlugin):
+                await worker.wait_closed()
+        if metrics_server:
+            metrics_server.close()
+        _QUEUE_DEPTH.untrack('bot')
+        executor.shutdown(wait=False)   # Running blocking work finishes in background
+
+
+def _close_workers(workers: List[AbstractPlugin]):
+    # Close all workers, even after failed ones, so their executors & processes get shut down
+    for worker in workers:
+        try:
             worker.close()
+        except Exception:   # pylint: disable=W0703
+            getLogger(__name__).exception('Closing worker "%s" failed!', worker.name)
+
+
+def _track_event_queues(event_queue: SafeQueue[Event], event_pool: Optional[ShardedPool[Event]]) -> Callable[[], None]:
+    # Expose depths & drops of event queues as metrics until returned function gets called (queues are gone then)
+    queue_names = ['bot']
+    if event_pool:
+        queue_names = ['bot_shard_{}'.format(index) for index in range(len(event_pool.get_depths()))]
+        for index, queue_name in enumerate(queue_names):
+            _QUEUE_DEPTH.track(lambda index=index: event_pool.get_depths()[index], queue_name)
+        _QUEUE_DROPPED.track(lambda: event_pool.dropped, 'bot')
+    else:
+        _QUEUE_DEPTH.track(lambda: len(event_queue), 'bot')
+        _QUEUE_DROPPED.track(lambda: event_queue.dropped, 'bot')
+    def untrack():
+        for queue_name in queue_names:
+            _QUEUE_DEPTH.untrack(queue_name)
+        _QUEUE_DROPPED.untrack('bot')
+    return untrack
+
+
+def _start_metrics_server(general_config: Dict[str, str]) -> Optional[MetricsServer]:
+    # Expose metrics on local port if configured
+    metrics_port = general_config.get('metrics_port')
+    if metrics_port:
+        return MetricsServer(METRICS, int(metrics_port), general_config.get('metrics_host') or '127.0.0.1')
+    return None
 
 
 def _register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Event], None], config: Dict[str,Dict[str,str]], env: Dict[str, str]):
-    # Load plugins dynamically
-    for module_info in iter_modules(plugins.__path__):
-        if not module_info.ispkg:
-            module_register_plugins = import_module('.' + module_info.name, plugins.__package__).__dict__.get('register_plugins')
-            if module_register_plugins:
-                module_register_plugins(workers, publish_event, config, env)
+    # Import configured plugin modules only: internal ones by manifest, third-party ones by entry point named like config section
+    for plugin_module in PLUGIN_MODULES:
+        if plugin_module.is_configured(config, env):
+            import_module(plugin_module.name).register_plugins(workers, publish_event, config, env)
+    for entry_point in _get_plugin_entry_points():
+        if entry_point.name in config:
+            entry_point.load()(workers, publish_event, config, env)
 
 
-def _process_events(workers: List[AbstractPlugin], event_queue: SafeQueue[Event], stop_event: Optional[ThreadEvent]):
-    if workers:
-        try:
-            while not (stop_event and stop_event.is_set()):
-                event = event_queue.get(1)  # Timeout required because SIGINT / KeyboardInterrupt gets blocked too
-                if event:
-                    for worker in workers:
-                        if worker.name != event.publisher:
-                            worker.apply_event(event)
-        except KeyboardInterrupt:
-            pass
+@lru_cache(maxsize=None)
+def _get_plugin_entry_points() -> Tuple[Any, ...]:
+    # Scan installed distributions once
+    if not entry_points:
+        return ()
+    all_entry_points = entry_points()
+    if hasattr(all_entry_points, 'select'):
+        return tuple(all_entry_points.select(group='botlet.plugins'))
+    return tuple(all_entry_points.get('botlet.plugins', ()))
+
+
+def _process_events(router: '_EventRouter', event_queue: SafeQueue[Event], stop_event: Optional[ThreadEvent]):
+    try:
+        while not (stop_event and stop_event.is_set()):
+            for event in event_queue.get_batch(64, 1):  # Timeout required because SIGINT / KeyboardInterrupt gets blocked too
+                router.dispatch(event)
+    except KeyboardInterrupt:
+        pass
+
+
+def _wait_stop(stop_event: Optional[ThreadEvent]):
+    try:
+        while not (stop_event and stop_event.is_set()):
+            sleep(1)    # Short sleeps because SIGINT / KeyboardInterrupt gets blocked too
+    except KeyboardInterrupt:
+        pass
+
+
+def _get_shard_key(event: Event) -> Hashable:
+    # Same chat channel keeps order of its events
+    data = event.data
+    if isinstance(data, ChatCommandEventData):
+        return (event.publisher, data.channel_id)
+    if isinstance(data, ChatOutputEventData):
+        return (data.target_publisher, data.target_channel_id)
+    return event.publisher
+
+
+def _get_coalesce_key(event: Event) -> Hashable:
+    # Newer status of publisher supersedes queued one, commands & replies are unique
+    if isinstance(event.data, StatusEventData):
+        return (StatusEventData, event.publisher)
+    return object()
+
+
+class _EventRouter:
+    """ Index of workers by event data types & commands to dispatch events to interested workers only """
+    def __init__(self, workers: List[AbstractPlugin], commands: CommandRegistry, timed: bool = False):
+        self._timed = timed # Collect metrics of dispatching
+        self._type_routes: Dict[type, List[AbstractPlugin]] = {data_type: [] for data_type in EventData.__args__}
+        self._commands = commands
+        self._apply_timings: Dict[Tuple[str, type], HistogramChild] = {}
+        for worker in workers:
+            for data_type in worker.EVENT_DATA_TYPES if worker.EVENT_DATA_TYPES is not None else EventData.__args__:
+                self._type_routes[data_type].append(worker)
+            for command in worker.get_commands():
+                commands.register(command)
+
+    def get_workers(self, event: Event) -> List[AbstractPlugin]:
+        """ Get workers interested in event, excluding its publisher """
+        return [worker for worker in self._type_routes.get(type(event.data), []) if worker.name != event.publisher]
+
+    def dispatch(self, event: Event):
+        """ Apply event to command handler and interested workers """
+        if not self._timed:
+            if isinstance(event.data, ChatCommandEventData):
+                self._commands.dispatch(event)
+            for worker in self.get_workers(event):
+                worker.apply_event(event)
+            return
+        data_type = type(event.data)
+        _EVENTS.inc(event.publisher, data_type.__name__)
+        if isinstance(event.data, ChatCommandEventData):
+            start = perf_counter()
+            self._commands.dispatch(event)
+            self._get_apply_timing(CommandRegistry.NAME, data_type).observe(perf_counter() - start)
+        for worker in self.get_workers(event):
+            start = perf_counter()
+            worker.apply_event(event)
+            self._get_apply_timing(worker.name, data_type).observe(perf_counter() - start)
+
+    def _get_apply_timing(self, name: str, data_type: type) -> HistogramChild:
+        timing = self._apply_timings.get((name, data_type))
+        if not timing:
+            timing = self._apply_timings[(name, data_type)] = _APPLY_SECONDS.labels(name, data_type.__name__)
+        return timing
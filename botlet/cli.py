@@ -1,9 +1,10 @@
 """ Command line interface """
 from argparse import ArgumentParser
+from asyncio import run as async_run
 from logging import getLogger
 
 from . import __version__ as version
-from .bot import run as bot_run
+from .bot import run as bot_run, run_async as bot_run_async
 from .config import get_configuration, get_environment, init_logging
 
 
@@ -23,5 +24,11 @@ def main():
     env = get_environment(config.get('general', {}).get('environment_prefix'), args.environment)
     # Run bot
     log.info('Starting...')
-    bot_run(config, env)
+    if config.get('general', {}).get('runtime') == 'async':
+        try:
+            async_run(bot_run_async(config, env))
+        except KeyboardInterrupt:
+            pass
+    else:
+        bot_run(config, env)
     log.info('Stopping...')
@@ -1,8 +1,10 @@
 """ Plugins collection """
 from abc import ABC, abstractmethod
+from asyncio import AbstractEventLoop, get_running_loop, new_event_loop, run_coroutine_threadsafe, set_event_loop, wait
+from concurrent.futures import Future
 from logging import getLogger
 from threading import Event as ThreadEvent, Thread
-from typing import Callable, NamedTuple, Optional, Union
+from typing import Any, Awaitable, Callable, Coroutine, Dict, List, NamedTuple, Optional, Tuple, Type, Union
 
 
 # EVENTS
@@ -36,6 +38,9 @@ class Event(NamedTuple):
 # PLUGINS
 class AbstractPlugin(ABC):
     """ Base class to process events """
+    # Types of event data to apply, None for all (bot routes only matching events)
+    EVENT_DATA_TYPES: Optional[Tuple[Type[EventData], ...]] = None
+
     def __init__(self, name: str, publish_event: Optional[Callable[[Event], None]] = None):
         self.__name = name
         self.__publish_event = publish_event
@@ -51,6 +56,10 @@ class AbstractPlugin(ABC):
         """ Get plugin instance name """
         return self.__name
 
+    def get_commands(self) -> List['Command']:
+        """ Gets called once to register chat commands """
+        return []
+
     def _publish_event_data(self, data: EventData):
         if self.__publish_event:
             self.__publish_event(Event(self.__name, data))
@@ -72,3 +81,157 @@ class AbstractThreadedPlugin(AbstractPlugin):
         super().close()
         self._stopped.set()
         self.__thread.join(30)
+
+
+class AbstractAsyncPlugin(AbstractPlugin):
+    """ Base class to process events by coroutine on running event loop (or new thread with own loop) """
+    def __init__(self, name: str, run: Callable[[], Awaitable[None]], publish_event: Optional[Callable[[Event], None]] = None):
+        super().__init__(name, publish_event)
+        self._stopped = ThreadEvent()
+        async def run_logged():
+            try:
+                await run()
+            except Exception:   # pylint: disable=W0703
+                self._log.exception('Plugin run failed!')
+        try:
+            # Share event loop of asynchronous bot
+            self._loop: AbstractEventLoop = get_running_loop()
+            self.__stopped_future = self._loop.create_future()
+            self.__task = self._loop.create_task(run_logged())
+            self.__thread = None
+        except RuntimeError:
+            # Own event loop in new thread
+            self._loop = new_event_loop()
+            self.__stopped_future = self._loop.create_future()
+            self.__task = None
+            def run_loop():
+                set_event_loop(self._loop)
+                try:
+                    self._loop.run_until_complete(run_logged())
+                finally:
+                    self._loop.close()
+            self.__thread = Thread(target=run_loop)
+            self.__thread.start()
+
+    def close(self):
+        super().close()
+        self._stopped.set()
+        try:
+            self._loop.call_soon_threadsafe(self.__set_stopped)
+        except RuntimeError:
+            pass    # Loop already closed
+        if self.__thread:
+            self.__thread.join(30)
+
+    async def wait_closed(self, timeout: float = 30):
+        """ Wait for end of coroutine on shared event loop (after close) """
+        if self.__task:
+            await wait([self.__task], timeout=timeout)
+
+    def _run_coroutine(self, coroutine: Coroutine[Any, Any, None]):
+        """ Run coroutine in background on event loop of plugin (callable from any thread), logs its failure """
+        run_coroutine_threadsafe(coroutine, self._loop).add_done_callback(self.__log_failure)
+
+    async def _wait_stopped(self, timeout: float) -> bool:
+        """ Wait for close or timeout, return True on close """
+        await wait([self.__stopped_future], timeout=timeout)
+        return self.__stopped_future.done()
+
+    def __log_failure(self, future: Future):
+        if not future.cancelled() and future.exception():
+            self._log.error('Plugin coroutine failed!', exc_info=future.exception())
+
+    def __set_stopped(self):
+        if not self.__stopped_future.done():
+            self.__stopped_future.set_result(None)
+
+
+# COMMANDS
+class Command(NamedTuple):
+    """ Chat command declaration by plugin """
+    verb: str
+    handler: Callable[[Event, List[str]], None]    # Receives command event & arguments
+    arguments: Tuple[str, ...] = () # Argument names in order
+    required_arguments: int = 0 # Number of leading arguments which aren't optional
+
+    @property
+    def usage(self) -> str:
+        """ Get usage text by command grammar """
+        required = ''.join(' <{}>'.format(argument) for argument in self.arguments[:self.required_arguments])
+        optional = ''.join(' [<{}>'.format(argument) for argument in self.arguments[self.required_arguments:])
+        return self.verb + required + optional + ']' * (len(self.arguments) - self.required_arguments)
+
+
+class CommandRegistry:
+    """ Central table of plugin commands to parse once and dispatch by verb """
+    NAME = 'commands'
+    HELP_VERB = 'help'
+
+    def __init__(self, publish_event: Optional[Callable[[Event], None]] = None):
+        self._publish_event = publish_event
+        self._commands: Dict[str, Command] = {}
+        self._help_text: Optional[str] = None
+
+    def register(self, command: Command):
+        """ Add command, verb has to be unique """
+        if command.verb == self.HELP_VERB or command.verb in self._commands:
+            raise ValueError('Command verb "{}" already registered!'.format(command.verb))
+        self._commands[command.verb] = command
+        self._help_text = None
+
+    def get_help_text(self) -> str:
+        """ Get usage of all commands (cached) """
+        if self._help_text is None:
+            self._help_text = 'Commands:\n' + '\n'.join(
+                self._commands[verb].usage
+                for verb in sorted(self._commands.keys())
+            )
+        return self._help_text
+
+    def dispatch(self, event: Event) -> bool:
+        """ Apply command event to handler of verb, return True if command was known """
+        data: ChatCommandEventData = event.data
+        args = data.command.split()
+        if not args:
+            return False
+        verb = args.pop(0)
+        if verb == self.HELP_VERB:
+            self._reply(event, self.get_help_text())
+            return True
+        command = self._commands.get(verb)
+        if not command:
+            return False
+        if command.required_arguments <= len(args) <= len(command.arguments):
+            command.handler(event, args)
+        else:
+            self._reply(event, 'Usage: ' + command.usage)
+        return True
+
+    def _reply(self, event: Event, text: str):
+        if self._publish_event:
+            self._publish_event(Event(self.NAME, ChatOutputEventData(text, event.publisher, event.data.channel_id)))
+
+
+# MANIFEST
+class PluginModule(NamedTuple):
+    """ Declaration of plugin module to import only if configured """
+    name: str   # Absolute module name, providing function `register_plugins`
+    config_sections: Tuple[str, ...] = ()   # Any present section activates module
+    env_keys: Tuple[str, ...] = ()  # Any present environment key activates module
+
+    def is_configured(self, config: Dict[str,Dict[str,str]], env: Dict[str, str]) -> bool:
+        """ Check whether module could register plugins (always without declared sections & keys) """
+        return (not (self.config_sections or self.env_keys)) \
+            or any(section in config for section in self.config_sections) \
+            or any(env.get(key) for key in self.env_keys)
+
+
+# Internal plugin modules (third-party ones register by entry point group `botlet.plugins`)
+PLUGIN_MODULES = (
+    PluginModule(__name__ + '.chat', env_keys=('DISCORD_TOKEN', 'SLACK_TOKEN')),
+    PluginModule(__name__ + '.git', ('plugin.git',)),
+    PluginModule(__name__ + '.logging', ('plugin.logging',)),
+    PluginModule(__name__ + '.profiling', ('plugin.profiler',)),
+    PluginModule(__name__ + '.timer', ('plugin.heartbeat', 'plugin.cron')),
+    PluginModule(__name__ + '.webcrawl')
+)
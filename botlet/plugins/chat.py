@@ -1,17 +1,22 @@
 """ Plugins to connect as chat bots """
 from abc import ABC
-from asyncio import new_event_loop, set_event_loop, sleep
+from asyncio import AbstractEventLoop, Event as AsyncEvent, Queue as AsyncQueue, Task, TimeoutError as AsyncTimeoutError, get_running_loop, sleep, wait, wait_for
+from collections import deque
 from logging import getLogger
-from threading import Event as ThreadEvent
-from typing import Callable, Dict, List, NamedTuple, Union
+from os import name as os_name
+from signal import Signals
+from threading import Event as ThreadEvent, current_thread, main_thread
+from time import monotonic
+from typing import Awaitable, Callable, Deque, Dict, List, NamedTuple, Optional, Set, Tuple, Type, Union
 
+from aiohttp import ClientSession, ClientTimeout
 from discord import Client as DiscordClient, Message as DiscordMessage, DMChannel
-from discord.errors import DiscordException
+from discord.errors import DiscordException, HTTPException as DiscordHTTPException
 from slack import RTMClient as SlackRTMClient
-from slack.errors import SlackClientError
+from slack.errors import SlackApiError, SlackClientError
 
-from . import AbstractPlugin, AbstractThreadedPlugin, ChatCommandEventData, ChatOutputEventData, Event, EventData, StatusEventData
-from ..utils import SafeQueue
+from . import AbstractAsyncPlugin, AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Event, EventData, StatusEventData
+from ..utils import METRICS, OverflowPolicy, TtlCache
 
 
 # Beginning of text to be recognized as command by chat bots
@@ -26,45 +31,240 @@ _CHAT_COMMAND_SEPARATOR = '&&'
 _CHAT_COMMAND_ONLY_HINT = 'Hi there. I am a command processing bot, reacting to messages with prefix "{}". No smalltalk!'.format(_CHAT_COMMAND_PREFIX)
 
 
+# Metrics of outgoing messages
+_QUEUE_DEPTH = METRICS.gauge('botlet_queue_depth', 'Number of queued items', ('queue',))
+_QUEUE_DROPPED = METRICS.counter('botlet_queue_dropped_total', 'Items dropped by full queue', ('queue',))
+
+
 # Message text with target channel
 class _Message(NamedTuple):
     text: str
     channel_id: Union[str,int,None]
 
 
+# Messages queue filled thread-safe and awaited by event loop of chat client
+class _MessageQueue:
+    def __init__(self, maxsize: int = 256, overflow: OverflowPolicy = OverflowPolicy.DROP_NEWEST):
+        # Producer is bot event processing, so waiting for space would stall all plugins
+        if overflow not in (OverflowPolicy.DROP_NEWEST, OverflowPolicy.DROP_OLDEST):
+            raise ValueError('Message queue drops on overflow only!')
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._messages: Deque[_Message] = deque()
+        self._closed = False
+        # Event loop of consumer, known by first wait
+        self._ready: Optional[AsyncEvent] = None
+        self._loop: Optional[AbstractEventLoop] = None
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    @property
+    def overflow(self) -> OverflowPolicy:
+        """ Get policy on full queue """
+        return self._overflow
+
+    def put(self, message: _Message) -> bool:
+        """ Puts a message into queue, return True on success or False on a message dropped (by policy newest or oldest) """
+        success = True
+        if len(self._messages) >= self._maxsize:
+            if self._overflow == OverflowPolicy.DROP_NEWEST:
+                return False
+            try:
+                self._messages.popleft()
+            except IndexError:
+                pass    # Consumed meanwhile
+            success = False
+        self._messages.append(message)
+        self._wake()
+        return success
+
+    def close(self):
+        """ Wakes up consumer without messages """
+        self._closed = True
+        self._wake()
+
+    async def get_all(self) -> List[_Message]:
+        """ Waits for messages, then extracts all of them (empty on close) """
+        if not self._ready:
+            self._ready = AsyncEvent()
+            self._loop = get_running_loop()
+        while not (self._messages or self._closed):
+            self._ready.clear()
+            if self._messages or self._closed:
+                break
+            await self._ready.wait()
+        messages = []
+        while self._messages:
+            messages.append(self._messages.popleft())
+        return messages
+
+    def _wake(self):
+        if self._loop:
+            try:
+                self._loop.call_soon_threadsafe(self._ready.set)
+            except RuntimeError:
+                pass    # Loop already closed
+
+
+# Rate limiter by token bucket algorithm
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = monotonic()
+
+    async def acquire(self):
+        """ Waits for a token and takes it """
+        while True:
+            now = monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await sleep((1 - self._tokens) / self._rate)
+
+
+# Message size & rate limit per channel of chat platform
+class _SendLimits(NamedTuple):
+    message_limit: int  # Characters
+    rate: float # Messages per second
+    capacity: int   # Burst of messages
+
+
+# Sender of messages merged by channel up to message limit & rate limited per channel (by own task, so waiting channels don't hold up others)
+class _MessageSender:
+    def __init__(self,
+                 send: Callable[[Union[str,int], str], Awaitable[None]],
+                 partition_text: Callable[[str], List[str]],
+                 limits: _SendLimits,
+                 errors: Tuple[Type[Exception], ...],
+                 get_retry_after: Callable[[Exception], Optional[float]]):
+        self._send = send
+        self._partition_text = partition_text
+        self._limits = limits
+        self._errors = errors
+        self._get_retry_after = get_retry_after
+        self._channels: Dict[Union[str,int], Tuple[AsyncQueue, Task]] = {}  # Pending texts & sender task by channel
+        self._log = getLogger(__name__)
+
+    def put_all(self, messages: List[Tuple[Union[str,int], str]]):
+        """ Hands texts over to sender tasks of their channels, keeping order per channel (call on event loop) """
+        for channel_id, text in messages:
+            channel = self._channels.get(channel_id)
+            if not channel:
+                texts: AsyncQueue = AsyncQueue()
+                channel = self._channels[channel_id] = (texts, get_running_loop().create_task(self._run_channel(channel_id, texts)))
+            channel[0].put_nowait(text)
+
+    async def close(self):
+        """ Stops sender tasks, dropping unsent texts """
+        tasks = [task for _, task in self._channels.values()]
+        self._channels.clear()
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await wait(tasks)
+
+    def merge_texts(self, texts: List[str]) -> List[str]:
+        """ Partitions texts and merges them into least messages """
+        chunks: List[str] = []
+        for text in texts:
+            for part in self._partition_text(text):
+                if chunks and len(chunks[-1]) + 1 + len(part) <= self._limits.message_limit:
+                    chunks[-1] += '\n' + part
+                else:
+                    chunks.append(part)
+        return chunks
+
+    async def _run_channel(self, channel_id: Union[str,int], texts: AsyncQueue):
+        # Send texts arrived meanwhile merged, end after idle time (bucket is full again by then)
+        bucket = _TokenBucket(self._limits.rate, self._limits.capacity)
+        try:
+            while True:
+                try:
+                    batch = [await wait_for(texts.get(), self._IDLE_TIMEOUT)]
+                except AsyncTimeoutError:
+                    return
+                while not texts.empty():
+                    batch.append(texts.get_nowait())
+                for chunk in self.merge_texts(batch):
+                    await self._send_chunk(channel_id, bucket, chunk)
+        except Exception:   # pylint: disable=W0703
+            self._log.exception('Chat sender of channel %s failed!', channel_id)
+        finally:
+            if self._channels.get(channel_id, (None, None))[0] is texts:
+                del self._channels[channel_id]
+
+    async def _send_chunk(self, channel_id: Union[str,int], bucket: _TokenBucket, chunk: str):
+        backoff = 0.5
+        while True:
+            await bucket.acquire()
+            try:
+                await self._send(channel_id, chunk)
+                return
+            except self._errors as ex:  # pylint: disable=E0712
+                retry_after = self._get_retry_after(ex)
+                if retry_after is None:
+                    self._log.error('Chat send error: %s', ex)
+                    return
+                # Rate limited, retry same chunk to keep order
+                backoff = max(retry_after, backoff * 2)
+                self._log.warning('Chat send rate limited, retry in %.1f seconds.', backoff)
+                await sleep(backoff)
+
+    _IDLE_TIMEOUT = 60  # Seconds until task of channel without messages ends
+
+
 # Plugin template for common resources & operations
-class _ChatPlugin(AbstractThreadedPlugin, ABC):
-    def __init__(self, name: str, run: Callable[[], None], publish_event: Callable[[Event], None]):
-        self._message_queue = SafeQueue[_Message]()
+class _ChatPlugin(AbstractAsyncPlugin, ABC):
+    EVENT_DATA_TYPES = (ChatOutputEventData,)
+
+    def __init__(self, name: str, run: Callable[[], Awaitable[None]], publish_event: Callable[[Event], None], overflow: OverflowPolicy):
+        self._message_queue = _MessageQueue(overflow=overflow)
+        _QUEUE_DEPTH.track(lambda: len(self._message_queue), name)
         super().__init__(name, run, publish_event)
 
+    def close(self):
+        self._stopped.set()
+        self._message_queue.close()
+        _QUEUE_DEPTH.untrack(self.name)
+        super().close()
+
     def apply_event(self, event: Event):
         if isinstance(event.data, ChatOutputEventData):
             data: ChatOutputEventData = event.data
             if data.target_publisher is None or data.target_publisher == self.name:
                 if not self._message_queue.put(_Message(data.text, data.target_channel_id)):
-                    self._log.warning('Message queue is full! Event: %s', event)
+                    _QUEUE_DROPPED.inc(self.name)
+                    self._log.warning('Message queue is full! Overflow: %s, event: %s', self._message_queue.overflow.value, event)
 
 
 # DISCORD
 class DiscordPlugin(_ChatPlugin):
     """ Discord plugin class """
-    def __init__(self, name: str, publish_event: Callable[[Event], None], token: str, channel_id: int):
-        def run():
-            set_event_loop(new_event_loop())
-            _DiscordClient(self._stopped, self._message_queue, channel_id, self._publish_event_data).run(token)
-        super().__init__(name, run, publish_event)
+    def __init__(self, name: str, publish_event: Callable[[Event], None], token: str, channel_id: int, overflow: OverflowPolicy = OverflowPolicy.DROP_NEWEST):
+        async def run():
+            await _DiscordClient(self._loop, self._stopped, self._message_queue, channel_id, self._publish_event_data).start(token)
+        super().__init__(name, run, publish_event, overflow)
 
 
 class _DiscordClient(DiscordClient):
     """ Client connected to discord bot """
-    def __init__(self, should_logout: ThreadEvent, message_queue: SafeQueue[_Message], default_channel_id: int, publish_event_data: Callable[[EventData], None]):
-        super().__init__()
+    def __init__(self, loop: AbstractEventLoop, should_logout: ThreadEvent, message_queue: _MessageQueue, default_channel_id: int, publish_event_data: Callable[[EventData], None]):
+        super().__init__(loop=loop)
         self._should_logout = should_logout
         self._message_queue = message_queue
         self._default_channel_id = default_channel_id
         self._publish_event_data = publish_event_data
         self._log = getLogger(__name__)
+        self._sender = _MessageSender(
+            self._send_text, self._partition_text,
+            _SendLimits(self._MESSAGE_LIMIT, 1, 5), # Channel rate limit of discord: 5 messages per 5 seconds
+            (DiscordException,), self._get_retry_after
+        )
         self.loop.create_task(self.background_task())
 
     async def on_ready(self):
@@ -93,50 +293,74 @@ class _DiscordClient(DiscordClient):
         """ Background runner """
         await self.wait_until_ready()
         while not self._should_logout.is_set():
-            message = self._message_queue.get()
-            if message and message.text:
-                try:
-                    channel = self.get_channel(message.channel_id if isinstance(message.channel_id, int) else self._default_channel_id)
-                    if channel:
-                        for text in self._partition_text(message.text):
-                            await channel.send(text)
-                except DiscordException as ex:
-                    self._log.error('Discord task error: %s', ex)
-            await sleep(0.5)
+            self._sender.put_all([
+                (message.channel_id if isinstance(message.channel_id, int) else self._default_channel_id, message.text)
+                for message in await self._message_queue.get_all()
+                if message.text
+            ])
+        await self._sender.close()
         await self.logout()
 
+    async def _send_text(self, channel_id: int, text: str):
+        channel = self.get_channel(channel_id)
+        if channel:
+            await channel.send(text)
+
     @staticmethod
-    def _partition_text(text: str) -> List[str]:
-        message_limit = 2000    # Message characters limit of discord
+    def _get_retry_after(ex: Exception) -> Optional[float]:
+        if isinstance(ex, DiscordHTTPException) and ex.status == 429:
+            return float(ex.response.headers.get('Retry-After', 1))
+        return None
+
+    _MESSAGE_LIMIT = 2000    # Message characters limit of discord
+    @classmethod
+    def _partition_text(cls, text: str) -> List[str]:
         return [
-            text[i:i+message_limit]
-            for i in range(0, min(len(text), message_limit * 5), message_limit)
+            text[i:i+cls._MESSAGE_LIMIT]
+            for i in range(0, min(len(text), cls._MESSAGE_LIMIT * 5), cls._MESSAGE_LIMIT)
         ]
 
 
 # SLACK
 class SlackPlugin(_ChatPlugin):
     """ Slack plugin class """
-    def __init__(self, name: str, publish_event: Callable[[Event], None], token: str, channel_id: str):
-        def run():
-            set_event_loop(new_event_loop())
-            _SlackClient(token, self._stopped, self._message_queue, channel_id, self._publish_event_data).start()
-        super().__init__(name, run, publish_event)
+    def __init__(self, name: str, publish_event: Callable[[Event], None], token: str, channel_id: str, overflow: OverflowPolicy = OverflowPolicy.DROP_NEWEST):
+        async def run():
+            await _SlackClient(self._loop, token, self._stopped, self._message_queue, channel_id, self._publish_event_data).start()
+        super().__init__(name, run, publish_event, overflow)
 
 
 class _SlackClient(SlackRTMClient):
     """ Client connected to slack legacy bot """
-    def __init__(self, token: str, should_logout: ThreadEvent, message_queue: SafeQueue[_Message], default_channel_id: str, publish_event_data: Callable[[EventData], None]):
-        super().__init__(token=token)
+    def __init__(self, loop: AbstractEventLoop, token: str, should_logout: ThreadEvent, message_queue: _MessageQueue,  # pylint: disable=R0913
+                 default_channel_id: str, publish_event_data: Callable[[EventData], None]):
+        super().__init__(token=token, run_async=True, loop=loop)
         self._log = getLogger(__name__)
         self._user = None
+        self._channel_is_im = TtlCache[str, bool](3600)
+        self._hint_tasks: Set[Task] = set() # Referenced until done, event loop keeps weak references only
 
-        def on_ready(**payload):
+        async def on_ready(**payload):
             self._user = payload['data']['self'] # Base client just saves token, not user information
             publish_event_data(StatusEventData('Slack login: ' + str(self._user)))
         self.on(event='open', callback=on_ready)
 
-        def on_message(**payload):
+        async def respond_hint(channel_id: str):
+            try:
+                is_im = self._channel_is_im.get(channel_id)
+                if is_im is None:
+                    conversation = await self._web_client.conversations_info(channel=channel_id)
+                    is_im = bool(conversation.get('channel', {}).get('is_im'))
+                    self._channel_is_im.put(channel_id, is_im)
+                if is_im:
+                    await self._web_client.chat_postMessage(
+                        channel=channel_id,
+                        text=self._escape_text(_CHAT_COMMAND_ONLY_HINT)
+                    )
+            except SlackClientError as ex:
+                self._log.error('Slack message error: %s', ex)
+
+        async def on_message(**payload):
             data: dict = payload['data']
             if 'text' in data and 'channel' in data and 'user' in data:
                 text: str = self._unescape_text(data['text'])
@@ -148,34 +372,52 @@ class _SlackClient(SlackRTMClient):
                     if text.startswith(_CHAT_COMMAND_PREFIX):
                         for command in map(str.strip, text[len(_CHAT_COMMAND_PREFIX):].split(_CHAT_COMMAND_SEPARATOR)):
                             publish_event_data(ChatCommandEventData(command, channel_id))
-                    # Respond with hint on direct message
+                    # Respond with hint on direct message (without blocking further messages reading)
                     else:
-                        try:
-                            conversation = self._web_client.conversations_info(channel=channel_id)
-                            if conversation.get('channel', {}).get('is_im'):
-                                self._web_client.chat_postMessage(
-                                    channel=channel_id,
-                                    text=self._escape_text(_CHAT_COMMAND_ONLY_HINT)
-                                )
-                        except SlackClientError as ex:
-                            self._log.error('Slack message error: %s', ex)
+                        task = self._event_loop.create_task(respond_hint(channel_id))
+                        self._hint_tasks.add(task)
+                        task.add_done_callback(self._hint_tasks.discard)
         self.on(event='message', callback=on_message)
 
+        async def send_text(channel_id: str, text: str):
+            await self._web_client.chat_postMessage(channel=channel_id, text=text)
+        sender = _MessageSender(
+            send_text, lambda text: [self._escape_text(text)],
+            _SendLimits(self._MESSAGE_LIMIT, 1, 3), # Channel rate limit of slack: about 1 message per second, short bursts allowed
+            (SlackClientError,), self._get_retry_after
+        )
         async def background_task():
-            while not should_logout.is_set():
-                message = message_queue.get()
-                if message and message.text:
-                    try:
-                        self._web_client.chat_postMessage(
-                            channel=message.channel_id if isinstance(message.channel_id, str) else default_channel_id,
-                            text=self._escape_text(message.text)
-                        )
-                    except SlackClientError as ex:
-                        self._log.error('Slack task error: %s', ex)
-                await sleep(0.5)
-            self.stop()
+            # Reuse connections for web api calls (base client opens a session per call)
+            self._web_client.session = ClientSession(timeout=ClientTimeout(total=self.timeout))
+            try:
+                while not should_logout.is_set():
+                    sender.put_all([
+                        (message.channel_id if isinstance(message.channel_id, str) else default_channel_id, message.text)
+                        for message in await message_queue.get_all()
+                        if message.text
+                    ])
+            finally:
+                await sender.close()
+                self.stop()
+                await self._web_client.session.close()
         self._event_loop.create_task(background_task())
 
+    def start(self) -> Awaitable:
+        future = super().start()
+        # Signals stay in control of bot (base client handles them on main thread)
+        if os_name != 'nt' and current_thread() == main_thread():
+            for signal_name in ('SIGHUP', 'SIGINT', 'SIGTERM'):
+                self._event_loop.remove_signal_handler(Signals[signal_name])
+        return future
+
+    @staticmethod
+    def _get_retry_after(ex: Exception) -> Optional[float]:
+        if isinstance(ex, SlackApiError) and ex.response.status_code == 429:
+            return float(ex.response.headers.get('Retry-After', 1))
+        return None
+
+    _MESSAGE_LIMIT = 40000  # Message characters limit of slack
+
     # Special text characters to escape, see <https://api.slack.com/reference/surfaces/formatting#escaping>
     _TEXT_ESCAPES = {
         '&': '&amp;',
@@ -186,7 +428,7 @@ class _SlackClient(SlackRTMClient):
     def _escape_text(cls, text: str) -> str:
         for character, escape in cls._TEXT_ESCAPES.items():
             text = text.replace(character, escape)
-        return text[:40000] # Message characters limit of slack
+        return text[:cls._MESSAGE_LIMIT]
 
     @classmethod
     def _unescape_text(cls, text: str) -> str:
@@ -196,15 +438,19 @@ class _SlackClient(SlackRTMClient):
 
 
 # REGISTRATION
-def register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Event], None], _config: Dict[str,Dict[str,str]], env: Dict[str, str]):
+def register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Event], None], config: Dict[str,Dict[str,str]], env: Dict[str, str]):
     """ Register local plugins to bot """
+    # Outgoing messages follow overflow policy of bot events, if it drops
+    overflow = OverflowPolicy(config.get('general', {}).get('event_overflow') or OverflowPolicy.DROP_NEWEST.value)
+    if overflow not in (OverflowPolicy.DROP_NEWEST, OverflowPolicy.DROP_OLDEST):
+        overflow = OverflowPolicy.DROP_NEWEST
     # Discord
     discord_token = env.get('DISCORD_TOKEN')
     discord_channel_id = env.get('DISCORD_CHANNEL_ID')
     if discord_token and discord_channel_id:
-        workers.append(DiscordPlugin('discord', publish_event, discord_token, int(discord_channel_id)))
+        workers.append(DiscordPlugin('discord', publish_event, discord_token, int(discord_channel_id), overflow))
     # Slack
     slack_token = env.get('SLACK_TOKEN')
     slack_channel_id = env.get('SLACK_CHANNEL_ID')
     if slack_token and slack_channel_id:
-        workers.append(SlackPlugin('slack', publish_event, slack_token, slack_channel_id))
+        workers.append(SlackPlugin('slack', publish_event, slack_token, slack_channel_id, overflow))
@@ -1,103 +1,595 @@
 """ Plugins to work with git repositories """
+from collections import OrderedDict
+from concurrent.futures import wait
+from hashlib import sha1
+from heapq import heappop, heappush
 from logging import getLogger
+from os import listdir, makedirs, scandir, utime
+from os.path import getmtime, isdir, join as path_join
 from re import compile as regex_compile
 from shutil import which
-from subprocess import CalledProcessError, run as process_run, DEVNULL
-from threading import Thread
-from typing import Callable, Dict, List
+from subprocess import CompletedProcess, DEVNULL, PIPE, Popen, SubprocessError, run as process_run
+from tempfile import gettempdir
+from threading import Lock
+from time import monotonic, time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Set, Tuple
 
-from . import AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Event
-from ..utils import SafeTemporaryDirectory
+from . import AbstractAsyncPlugin, AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Command, Event, StatusEventData
+from ..utils import METRICS, BoundedExecutor, LoadingCache, safe_rmtree
+
+
+# Options in configuration section, all other entries are repositories
+_GIT_OPTIONS = (
+    'cache_dir', 'cache_size', 'branches_ttl', 'branches_stale_ttl', 'fetch_ttl', 'watch_interval', 'watch_branches', 'fan_out_timeout', 'workers', 'queue_size',
+    'timeout'
+)
+
+
+# Metrics of git processes
+_SUBPROCESS_SECONDS = METRICS.histogram('botlet_subprocess_seconds', 'Duration of subprocesses', ('command',))
+_PROCESSES_STARTED = METRICS.counter('botlet_subprocesses_total', 'Started subprocesses', ('command',))
 
 
 # PLUGINS
 class GitPlugin(AbstractPlugin):
     """ Git plugin class """
-    def __init__(self, name: str, publish_event: Callable[[Event], None], repositories: Dict[str, str]):
+    EVENT_DATA_TYPES = ()
+
+    def __init__(self, name: str, publish_event: Callable[[Event], None], repositories: Dict[str, str], backend: '_GitBackend', fan_out_timeout: float = 10):
         super().__init__(name, publish_event)
         self._repositories = repositories
+        self._mirrors = backend.mirrors
+        self._branches = backend.branches
+        self._executor = backend.executor
+        self._watcher = backend.watcher # Answers from memory if ready
+        self._fan_out = _GitFanOut(backend.executor, fan_out_timeout)
         self._branch_pattern = regex_compile(r'[a-zA-Z0-9/_:\.\-\+\*]+')
 
+    def close(self):
+        super().close()
+        self._executor.shutdown(False)
+        self._mirrors.close()
+
     def apply_event(self, event: Event):
-        # Is valid plugin command?
-        if isinstance(event.data, ChatCommandEventData):
-            data: ChatCommandEventData = event.data
-            args = data.command.split(maxsplit=3)
-            args_number = len(args)
-            if args_number == 1 and args[0] == 'help':
-                self._publish_event_data(ChatOutputEventData('Command: git [<REPOSITORY> [<BRANCH>]]', event.publisher, data.channel_id))
-            if args_number >= 1 and args[0] == 'git':
-                # Evaluate command arguments
-                if args_number == 1:
-                    # Show available repositories
-                    self._publish_event_data(ChatOutputEventData('Repositories: ' + ', '.join(sorted(self._repositories.keys())), event.publisher, data.channel_id))
+        """ Unused """
+
+    def get_commands(self) -> List[Command]:
+        return [Command('git', self._apply_git_command, ('REPOSITORY', 'BRANCH'))]
+
+    def _apply_git_command(self, event: Event, args: List[str]):
+        data: ChatCommandEventData = event.data
+        # Evaluate command arguments
+        if not args:
+            # Show available repositories
+            self._publish_event_data(ChatOutputEventData('Repositories: ' + ', '.join(sorted(self._repositories.keys())), event.publisher, data.channel_id))
+        elif args[0] == '*' or ',' in args[0]:
+            self._apply_fan_out(event, args)
+        else:
+            repository = self._repositories.get(args[0])
+            watched_branches = self._watcher.get_branches(args[0]) if repository and len(args) == 1 and self._watcher else None
+            if not repository:
+                self._publish_event_data(ChatOutputEventData('Repository not found!', event.publisher, data.channel_id))
+            elif watched_branches is not None:
+                self._publish_event_data(ChatOutputEventData('Branches: ' + ', '.join(watched_branches), event.publisher, data.channel_id))
+            elif len(args) == 1:
+                # Show available repository branches
+                def run():
+                    try:
+                        self._publish_event_data(ChatOutputEventData(
+                            'Branches: ' + ', '.join(self._branches.get(repository)),
+                            event.publisher, data.channel_id
+                        ))
+                    except (OSError, SubprocessError) as ex:
+                        self._log.error('Git failed: %s', ex)
+                        self._publish_event_data(ChatOutputEventData('Branches request failed!', event.publisher, data.channel_id))
+                self._submit(run, event)
+            else:
+                branch = args[1]
+                watched_commits = self._watcher.get_commits(args[0], branch) if self._watcher and self._branch_pattern.fullmatch(branch) else None
+                if not self._branch_pattern.fullmatch(branch):
+                    self._publish_event_data(ChatOutputEventData('Invalid branch name!', event.publisher, data.channel_id))
+                elif watched_commits:
+                    self._publish_event_data(ChatOutputEventData('Commits:\n' + _format_commits(watched_commits), event.publisher, data.channel_id))
                 else:
-                    repository = self._repositories.get(args[1])
-                    if not repository:
-                        self._publish_event_data(ChatOutputEventData('Repository not found!', event.publisher, data.channel_id))
-                    else:
-                        if args_number == 2:
-                            # Show available repository branches
-                            def run():
-                                try:
-                                    self._publish_event_data(ChatOutputEventData(
-                                        'Branches: ' + ', '.join(_get_repository_branches(repository)),
-                                        event.publisher, data.channel_id
-                                    ))
-                                except (OSError, CalledProcessError) as ex:
-                                    self._log.error('Git failed: %s', ex)
-                                    self._publish_event_data(ChatOutputEventData('Branches request failed!', event.publisher, data.channel_id))
-                            Thread(target=run, daemon=True).start()
-                        else:   # args_number == 3
-                            branch = args[2]
-                            if not self._branch_pattern.fullmatch(branch):
-                                self._publish_event_data(ChatOutputEventData('Invalid branch name!', event.publisher, data.channel_id))
-                            else:
-                                # Show last commits of repository branch
-                                def run():
-                                    try:
-                                        self._publish_event_data(ChatOutputEventData(
-                                            'Commits:\n' + _get_repository_branch_commits(repository, branch),
-                                            event.publisher, data.channel_id
-                                        ))
-                                    except (OSError, CalledProcessError) as ex:
-                                        self._log.error('Git failed: %s', ex)
-                                        self._publish_event_data(ChatOutputEventData('Commits request failed!', event.publisher, data.channel_id))
-                                Thread(target=run, daemon=True).start()
+                    # Show last commits of repository branch
+                    def run():
+                        try:
+                            self._publish_event_data(ChatOutputEventData(
+                                'Commits:\n' + self._mirrors.get_branch_commits(repository, branch),
+                                event.publisher, data.channel_id
+                            ))
+                        except (OSError, SubprocessError) as ex:
+                            self._log.error('Git failed: %s', ex)
+                            self._publish_event_data(ChatOutputEventData('Commits request failed!', event.publisher, data.channel_id))
+                    self._submit(run, event)
+
+    def _apply_fan_out(self, event: Event, args: List[str]):
+        # Same request to multiple repositories at once, answered by one message
+        data: ChatCommandEventData = event.data
+        names = sorted(self._repositories.keys()) if args[0] == '*' else list(dict.fromkeys(name for name in args[0].split(',') if name))
+        missing_names = [name for name in names if name not in self._repositories]
+        branch = args[1] if len(args) > 1 else None
+        if not names or missing_names:
+            self._publish_event_data(ChatOutputEventData('Repository not found! ' + ', '.join(missing_names), event.publisher, data.channel_id))
+        elif branch is not None and not self._branch_pattern.fullmatch(branch):
+            self._publish_event_data(ChatOutputEventData('Invalid branch name!', event.publisher, data.channel_id))
+        else:
+            def run(name: str) -> str:
+                try:
+                    if branch is None:
+                        return '{}: {}'.format(name, ', '.join(self._branches.get(self._repositories[name])))
+                    watched_commits = self._watcher.get_commits(name, branch) if self._watcher else None
+                    return '{}/{}:\n{}'.format(
+                        name, branch, _format_commits(watched_commits) if watched_commits else self._mirrors.get_branch_commits(self._repositories[name], branch)
+                    )
+                except (OSError, SubprocessError) as ex:
+                    self._log.error('Git failed: %s', ex)
+                    return '{}: request failed!'.format(name)
+            def publish(text: str):
+                self._publish_event_data(ChatOutputEventData(text, event.publisher, data.channel_id))
+            if not self._fan_out.run({name: lambda name=name: run(name) for name in names}, publish):
+                publish('Git is busy, try again later!')
+
+    def _submit(self, run: Callable[[], None], event: Event):
+        # Admission control of git processes
+        if not self._executor.submit(run):
+            self._publish_event_data(ChatOutputEventData('Git is busy, try again later!', event.publisher, event.data.channel_id))
+
+
+class GitWatcherPlugin(AbstractAsyncPlugin):
+    """ Git watcher plugin class, polling repositories & publishing moved branches """
+    EVENT_DATA_TYPES = ()
+
+    def __init__(self, name: str, publish_event: Callable[[Event], None], watcher: '_GitWatcher', interval: float):
+        async def run():
+            while True:
+                for repository_name, branch, commits in await self._loop.run_in_executor(None, watcher.poll):
+                    self._publish_event_data(StatusEventData('Git branch {}/{} moved:\n{}'.format(repository_name, branch, _format_commits(commits[:1]))))
+                if await self._wait_stopped(interval):
+                    break
+        super().__init__(name, run, publish_event)
+
+    def apply_event(self, event: Event):
+        """ Unused """
 
 
 # REGISTRATION
 def register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Event], None], config: Dict[str,Dict[str,str]], _env: Dict[str, str]):
     """ Register local plugins to bot """
-    repositories = config.get('plugin.git')
+    git_config = config.get('plugin.git', {})
+    repositories = {key: value for key, value in git_config.items() if key not in _GIT_OPTIONS}
+    timeout = float(git_config.get('timeout') or 60)
     if repositories:
         if which('git'):
-            workers.append(GitPlugin('git', publish_event, repositories))
+            mirrors = _GitMirrors(
+                git_config.get('cache_dir') or path_join(gettempdir(), 'botlet_git'),
+                int(float(git_config.get('cache_size') or 1024) * 1024 * 1024),
+                timeout,
+                float(git_config.get('fetch_ttl') or 0)
+            )
+            watch_interval = float(git_config.get('watch_interval') or 0)
+            watcher = _GitWatcher(
+                repositories, mirrors,
+                {branch.strip() for branch in (git_config.get('watch_branches') or '').split(',') if branch.strip()},
+                timeout
+            ) if watch_interval > 0 else None
+            if watcher:
+                workers.append(GitWatcherPlugin('git_watcher', publish_event, watcher, watch_interval))  # Closed before mirrors
+            workers.append(GitPlugin(
+                'git', publish_event, repositories,
+                _GitBackend(
+                    mirrors,
+                    LoadingCache[str, List[str]](
+                        lambda repository: _get_repository_branches(repository, timeout),
+                        float(git_config.get('branches_ttl') or 60),
+                        float(git_config.get('branches_stale_ttl') or 3600)
+                    ),
+                    BoundedExecutor(int(git_config.get('workers') or 4), int(git_config.get('queue_size') or 16), 'botlet_git'),
+                    watcher
+                ),
+                float(git_config.get('fan_out_timeout') or 10)
+            ))
         else:
             getLogger(__name__).warning('Git plugins require git installed!')
 
 
 # HELPERS
-def _get_repository_branches(repository: str) -> List[str]:
-    return list(sorted(filter(
-        None,
-        map(
-            lambda line: line.partition('refs/heads/')[2],
-            process_run(
-                ['git', 'ls-remote', '-h', repository],
-                capture_output=True, text=True, check=True
-            ).stdout.splitlines()
-        )
-    )))
+def _run_git(args: List[str], **kwargs: Any) -> CompletedProcess:
+    _PROCESSES_STARTED.inc(' '.join(args[:2]))
+    with _SUBPROCESS_SECONDS.time(' '.join(args[:2])):
+        return process_run(args, **kwargs)  # pylint: disable=W1510
+
+
+class _GitBackend(NamedTuple):
+    """ Shared resources of git plugin """
+    mirrors: '_GitMirrors'
+    branches: LoadingCache[str, List[str]]
+    executor: BoundedExecutor
+    watcher: Optional['_GitWatcher'] = None
+
+
+def _get_repository_branches(repository: str, timeout: Optional[float] = None) -> List[str]:
+    return list(sorted(_get_repository_heads(repository, timeout).keys()))
+
+
+def _get_repository_heads(repository: str, timeout: Optional[float] = None) -> Dict[str, str]:
+    # Commit hash by branch
+    heads = {}
+    for line in _run_git(['git', 'ls-remote', '-h', repository], capture_output=True, text=True, check=True, timeout=timeout).stdout.splitlines():
+        sha, _, ref = line.partition('\t')
+        branch = ref.partition('refs/heads/')[2]
+        if branch:
+            heads[branch] = sha
+    return heads
+
+
+class _GitFanOut:
+    """ Requests to multiple repositories by shared executor, answered together once all arrived or their timeouts passed """
+    def __init__(self, executor: BoundedExecutor, timeout: float):
+        self._executor = executor
+        self._timeout = timeout # Seconds per repository since start of its request
+        self._log = getLogger(__name__)
+
+    def run(self, requests: Dict[str, Callable[[], str]], publish: Callable[[str], None]) -> bool:
+        """ Run requests by repository name & publish their texts in order, False if executor is too busy """
+        started: Dict[str, float] = {}
+        def call(name: str, request: Callable[[], str]) -> str:
+            started[name] = monotonic()
+            return request()
+        futures = {name: self._executor.submit(lambda name=name, request=request: call(name, request)) for name, request in requests.items()}
+        def collect():
+            # Queued after requests, so all of them started already (or are done)
+            texts = []
+            for name, future in futures.items():
+                if not future:
+                    texts.append('{}: git is busy, try again later!'.format(name))
+                elif not wait([future], max(started.get(name, monotonic()) + self._timeout - monotonic(), 0)).done:
+                    texts.append('{}: timed out!'.format(name))
+                elif future.exception():
+                    self._log.error('Git request of %s failed!', name, exc_info=future.exception())
+                    texts.append('{}: request failed!'.format(name))
+                else:
+                    texts.append(future.result())
+            publish('\n'.join(texts))
+        # Make room for collection by cancelling last queued requests if necessary
+        for name in reversed(list(futures)):
+            if self._executor.submit(collect):
+                return True
+            future = futures[name]
+            if future and future.cancel():
+                futures[name] = None
+        if self._executor.submit(collect):
+            return True
+        for future in futures.values():
+            if future:
+                future.cancel()
+        return False
+
+
+class _WatchedRepository:
+    """ Polled state of repository """
+    def __init__(self, url: str):
+        self.url = url
+        self.heads: Optional[Dict[str, str]] = None # Commit hash by branch, None if not polled yet
+        self.requested: 'OrderedDict[str, None]' = OrderedDict()  # Branches watched by requests, least recently requested first
+        self.commits: Dict[str, Tuple[str, List[_GitCommit]]] = {}  # Head hash & commits by branch
+
 
+class _GitWatcher:
+    """ Polls remote branches of repositories & keeps commits of changed watched branches ready """
+    def __init__(self, repositories: Dict[str, str], mirrors: '_GitMirrors', watched_branches: Set[str], timeout: Optional[float] = None,
+                 max_requested_branches: int = 16):
+        self._repositories = {name: _WatchedRepository(url) for name, url in repositories.items()}
+        self._mirrors = mirrors
+        self._timeout = timeout
+        self._watched_branches = frozenset(watched_branches)    # Configured ones, always watched
+        self._max_requested_branches = max_requested_branches   # Per repository, beyond configured ones
+        self._lock = Lock()
+        self._log = getLogger(__name__)
 
-def _get_repository_branch_commits(repository: str, branch: str) -> str:
-    with SafeTemporaryDirectory(prefix='botlet_', suffix='.git') as dir_path:
-        process_run(
-            ['git', 'clone', repository, '-b', branch, '--depth=3', '--bare', '--filter=blob:none', '-q', dir_path],
-            stdout=DEVNULL, stderr=DEVNULL, check=True
+    def get_branches(self, name: str) -> Optional[List[str]]:
+        """ Get branches by last poll, None if not polled yet """
+        heads = self._repositories[name].heads
+        return None if heads is None else list(sorted(heads.keys()))
+
+    def get_commits(self, name: str, branch: str) -> Optional[List['_GitCommit']]:
+        """ Get commits of branch by last poll, None if not ready (existing branch gets watched from now on) """
+        repository = self._repositories[name]
+        with self._lock:
+            if branch not in self._watched_branches and repository.heads and branch in repository.heads:
+                # Limit watched branches by requests, dropping least recently requested ones
+                repository.requested.pop(branch, None)
+                repository.requested[branch] = None
+                while len(repository.requested) > self._max_requested_branches:
+                    repository.commits.pop(repository.requested.popitem(last=False)[0], None)
+            commits = repository.commits.get(branch)
+        return commits[1] if commits else None
+
+    def poll(self) -> List[Tuple[str, str, List['_GitCommit']]]:
+        """ Update heads of repositories & commits of changed watched branches, return moved branches """
+        moved = []
+        for name, repository in self._repositories.items():
+            try:
+                heads = _get_repository_heads(repository.url, self._timeout)
+            except (OSError, SubprocessError) as ex:
+                self._log.warning('Polling git repository %s failed: %s', name, ex)
+                continue
+            with self._lock:
+                repository.heads = heads
+                # Deleted branches aren't watched by requests anymore
+                for branch in [branch for branch in repository.requested if branch not in heads]:
+                    del repository.requested[branch]
+                watched = self._watched_branches.union(repository.requested)
+            for branch in watched:
+                head = heads.get(branch)
+                previous = repository.commits.get(branch)
+                if previous and previous[0] == head:
+                    continue
+                if head is None:
+                    with self._lock:
+                        repository.commits.pop(branch, None)
+                    continue
+                try:
+                    commits = self._mirrors.get_branch_log(repository.url, branch, True)
+                except (OSError, SubprocessError) as ex:
+                    self._log.warning('Updating git branch %s/%s failed: %s', name, branch, ex)
+                    continue
+                with self._lock:
+                    if branch in self._watched_branches or branch in repository.requested:
+                        repository.commits[branch] = (head, commits)
+                if previous:
+                    moved.append((name, branch, commits))
+        return moved
+
+
+class _MirrorState:
+    """ Lock of mirror & state cached for it """
+    def __init__(self):
+        self.lock = Lock()
+        self.fetch_times: Dict[str, float] = {}  # Last fetch (monotonic) by ref
+        self.object_reader: Optional[_GitObjectReader] = None
+        self.size: Optional[int] = None # Bytes on disk, None if unknown
+
+
+class _GitMirrors:
+    """ Persistent bare repositories per remote, updated by incremental fetches & read by long-lived object readers """
+    def __init__(self, directory: str, max_size: int, timeout: Optional[float] = None, fetch_ttl: float = 0):
+        self._directory = directory
+        self._max_size = max_size   # Bytes
+        self._timeout = timeout # Seconds per git process
+        self._fetch_ttl = fetch_ttl # Seconds to reuse fetched branch
+        self._states: Dict[str, _MirrorState] = {}  # By mirror path
+        self._states_lock = Lock()
+        self._log = getLogger(__name__)
+
+    def close(self):
+        """ Stop object readers """
+        with self._states_lock:
+            states = list(self._states.values())
+        for state in states:
+            with state.lock:
+                if state.object_reader:
+                    state.object_reader.close()
+                    state.object_reader = None
+
+    def get_branch_commits(self, repository: str, branch: str) -> str:
+        """ Get last commits of repository branch """
+        return _format_commits(self.get_branch_log(repository, branch))
+
+    def get_branch_log(self, repository: str, branch: str, force_fetch: bool = False) -> List['_GitCommit']:
+        """ Get last commits of repository branch as objects (fetching once more with force) """
+        requested = monotonic()
+        mirror_path = self._get_mirror_path(repository)
+        state = self._get_state(mirror_path)
+        with state.lock:
+            if not isdir(mirror_path):
+                makedirs(self._directory, exist_ok=True)
+                _run_git(['git', 'init', '--bare', '-q', mirror_path], stdout=DEVNULL, stderr=DEVNULL, check=True, timeout=self._timeout)
+            # Share fetch of concurrent requests
+            ref = 'refs/heads/' + branch
+            fetched = state.fetch_times.get(ref, float('-inf')) < requested - (0 if force_fetch else self._fetch_ttl)
+            if fetched:
+                _run_git(
+                    ['git', 'fetch', '-q', '--depth=3', '--filter=blob:none', repository, '+{0}:{0}'.format(ref)],
+                    cwd=mirror_path, stdout=DEVNULL, stderr=DEVNULL, check=True, timeout=self._timeout
+                )
+                state.fetch_times[ref] = monotonic()
+                state.size = _get_directory_size(mirror_path)
+            utime(mirror_path)  # Last use for eviction
+            if not state.object_reader or not state.object_reader.is_alive():
+                if state.object_reader:
+                    state.object_reader.close()   # Frees pipes of terminated one
+                state.object_reader = _GitObjectReader(mirror_path)
+            commits = state.object_reader.get_commits(_read_ref(mirror_path, ref), 3)
+        # Only fetches grow the cache, its cleanup doesn't fail the request
+        if fetched:
+            try:
+                self._evict(mirror_path)
+            except OSError as ex:
+                self._log.warning('Evicting git mirrors failed: %s', ex)
+        return commits
+
+    def _get_mirror_path(self, repository: str) -> str:
+        return path_join(self._directory, sha1(repository.encode('utf-8')).hexdigest()[:16] + '.git')
+
+    def _get_state(self, mirror_path: str) -> _MirrorState:
+        with self._states_lock:
+            state = self._states.get(mirror_path)
+            if not state:
+                state = self._states[mirror_path] = _MirrorState()
+            return state
+
+    def _evict(self, used_mirror_path: str):
+        # Remove least recently used mirrors until cache fits size limit, by sizes cached after fetches
+        mirror_states = []
+        for name in listdir(self._directory):
+            if name.endswith('.git'):
+                mirror_path = path_join(self._directory, name)
+                state = self._get_state(mirror_path)
+                try:
+                    last_use = getmtime(mirror_path)
+                    if state.size is None:  # Left by previous run
+                        state.size = _get_directory_size(mirror_path)
+                except FileNotFoundError:
+                    continue    # Evicted concurrently
+                mirror_states.append((last_use, mirror_path, state))
+        mirror_states.sort(key=lambda mirror_state: mirror_state[0])
+        total_size = sum(state.size for _, _, state in mirror_states)
+        for _, mirror_path, state in mirror_states:
+            if total_size <= self._max_size:
+                break
+            if mirror_path != used_mirror_path and state.lock.acquire(blocking=False):
+                try:
+                    if state.object_reader:
+                        state.object_reader.close()
+                        state.object_reader = None
+                    if isdir(mirror_path):  # Not evicted concurrently meanwhile
+                        self._log.info('Evict git mirror: %s', mirror_path)
+                        safe_rmtree(mirror_path)
+                    state.fetch_times.clear()
+                    total_size -= state.size
+                    state.size = 0
+                finally:
+                    state.lock.release()
+
+
+def _get_directory_size(path: str) -> int:
+    size = 0
+    for entry in scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            size += _get_directory_size(entry.path)
+        else:
+            size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+
+class _GitCommit(NamedTuple):
+    sha: str
+    subject: str
+    committer: str
+    commit_time: int    # Unix timestamp
+    parents: Tuple[str, ...]
+
+
+class _GitObjectReader:
+    """ Long-lived `git cat-file --batch` process of a repository, answering object requests in order """
+    def __init__(self, git_dir: str):
+        self._lock = Lock()
+        _PROCESSES_STARTED.inc('git cat-file')
+        # Spawned last, so constructed reader owns process & close() stops it
+        self._process = Popen(['git', 'cat-file', '--batch'], cwd=git_dir, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)   # pylint: disable=R1732
+
+    def is_alive(self) -> bool:
+        """ Check whether process still runs """
+        return self._process.poll() is None
+
+    def close(self):
+        """ Stop process by end of input """
+        try:
+            self._process.stdin.close()
+            self._process.wait(5)
+        except (OSError, SubprocessError):
+            self._process.kill()
+        self._process.stdout.close()
+
+    def get_object(self, name: str) -> Optional[Tuple[str, bytes]]:
+        """ Get type & content of object by name, None if missing """
+        with self._lock:
+            try:
+                self._process.stdin.write(name.encode('utf-8') + b'\n')
+                self._process.stdin.flush()
+                header = self._process.stdout.readline().split()
+                if len(header) != 3:
+                    if len(header) == 2:    # Missing or ambiguous
+                        return None
+                    raise SubprocessError('Git object reader terminated!')
+                content = self._process.stdout.read(int(header[2]) + 1)[:-1] # Without trailing newline
+                return header[1].decode('ascii'), content
+            except OSError as ex:
+                self._process.kill()
+                raise SubprocessError('Git object reader failed: {}'.format(ex)) from ex
+
+    def get_commits(self, sha: str, max_count: int) -> List[_GitCommit]:
+        """ Get newest commits by history of commit, ordered by commit time like `git log` """
+        commits: List[_GitCommit] = []
+        candidates = [(0, sha)]
+        seen = {sha}
+        while candidates and len(commits) < max_count:
+            commit = self._get_commit(heappop(candidates)[1])
+            if commit:  # Parents of shallow history are missing
+                commits.append(commit)
+                for parent in commit.parents:
+                    if parent not in seen:
+                        seen.add(parent)
+                        heappush(candidates, (-self._get_commit_time(parent), parent))
+        return commits
+
+    def _get_commit(self, sha: str) -> Optional[_GitCommit]:
+        git_object = self.get_object(sha)
+        if not git_object or git_object[0] != 'commit':
+            return None
+        head, _, message = git_object[1].partition(b'\n\n')
+        headers = [line.split(b' ', 1) for line in head.split(b'\n') if b' ' in line]
+        encoding = next((value.decode('ascii') for key, value in headers if key == b'encoding'), 'utf-8')
+        committer_name, _, committer_tail = next(value for key, value in headers if key == b'committer').decode(encoding, 'replace').partition(' <')
+        return _GitCommit(
+            sha,
+            ' '.join(line.strip() for line in message.decode(encoding, 'replace').strip().split('\n\n', 1)[0].splitlines()),
+            committer_name,
+            int(committer_tail.split()[-2]),
+            tuple(value.decode('ascii') for key, value in headers if key == b'parent')
         )
-        return process_run(
-            ['git', 'log', '-n3', '--no-decorate', '--format=[%h] %s (by %cn, %cr)'],
-            cwd=dir_path, capture_output=True, text=True, check=True
-        ).stdout.strip()
+
+    def _get_commit_time(self, sha: str) -> int:
+        commit = self._get_commit(sha)
+        return commit.commit_time if commit else 0
+
+
+def _read_ref(git_dir: str, ref: str) -> str:
+    # Resolve branch by files instead of git process: loose ref first, then packed refs
+    try:
+        with open(path_join(git_dir, *ref.split('/')), encoding='ascii') as file:
+            return file.read().strip()
+    except FileNotFoundError:
+        pass
+    with open(path_join(git_dir, 'packed-refs'), encoding='utf-8') as file:
+        for line in file:
+            sha, _, name = line.strip().partition(' ')
+            if name == ref:
+                return sha
+    raise FileNotFoundError('Git reference not found: ' + ref)
+
+
+def _format_commits(commits: List[_GitCommit]) -> str:
+    return '\n'.join(
+        '[{}] {} (by {}, {})'.format(commit.sha[:7], commit.subject, commit.committer, _format_relative_time(commit.commit_time))
+        for commit in commits
+    )
+
+
+def _format_relative_time(timestamp: int) -> str:
+    # Like git relative dates (%cr)
+    def plural(number: int, unit: str) -> str:
+        return '{} {}{}'.format(number, unit, '' if number == 1 else 's')
+    seconds = max(int(time()) - timestamp, 0)
+    minutes = (seconds + 30) // 60
+    hours = (minutes + 30) // 60
+    days = (hours + 12) // 24
+    if seconds < 90:
+        text = plural(seconds, 'second')
+    elif minutes < 90:
+        text = plural(minutes, 'minute')
+    elif hours < 36:
+        text = plural(hours, 'hour')
+    elif days < 14:
+        text = plural(days, 'day')
+    elif days < 70:
+        text = plural((days + 3) // 7, 'week')
+    elif days < 365:
+        text = plural((days + 15) // 30, 'month')
+    elif days < 1825:
+        years, months = divmod((days * 12 * 2 + 365) // (365 * 2), 12)
+        text = plural(years, 'year') + (', ' + plural(months, 'month') if months else '')
+    else:
+        text = plural((days + 183) // 365, 'year')
+    return text + ' ago'
@@ -0,0 +1,166 @@
+""" Plugins to inspect the running bot """
+from collections import Counter as CollectionCounter
+from datetime import datetime
+from os import makedirs
+from os.path import basename, join as path_join
+from signal import Signals, signal
+from sys import _current_frames # pylint: disable=W0212
+from tempfile import gettempdir
+from threading import Event as ThreadEvent, Lock, Thread, get_ident, enumerate as enumerate_threads
+from time import monotonic, sleep
+from types import FrameType
+from typing import Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+from . import AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Command, Event
+
+
+# Signal to start profile (POSIX only)
+_PROFILE_SIGNAL = getattr(Signals, 'SIGUSR1', None)
+
+
+class ProfilerSettings(NamedTuple):
+    """ Timing of profiles in seconds """
+    interval: float = 0.01  # Between samples
+    max_duration: float = 300   # Of profiles by command
+    signal_duration: float = 10 # Of profiles by signal
+
+
+# PLUGINS
+class ProfilerPlugin(AbstractPlugin):
+    """ Sampling profiler plugin class """
+    EVENT_DATA_TYPES = ()
+
+    def __init__(self, name: str, publish_event: Callable[[Event], None], output_dir: str, channel_ids: Set[str], settings: ProfilerSettings = ProfilerSettings()):
+        super().__init__(name, publish_event)
+        self._output_dir = output_dir
+        self._channel_ids = channel_ids # Allowed to request profiles by command
+        self._settings = settings
+        self._running = Lock()
+        # Profile on signal, replying to default chat channels
+        self._previous_handler = None
+        self._signalled = ThreadEvent()
+        self._closed = False
+        if _PROFILE_SIGNAL:
+            try:
+                # Handler interrupts any thread (even holding locks), so it only wakes up own thread
+                self._previous_handler = signal(_PROFILE_SIGNAL, lambda *_args: self._signalled.set())
+                Thread(target=self._await_signals, name='botlet_profiler_signal', daemon=True).start()
+            except ValueError as ex:    # Not main thread
+                self._log.warning('Profiling by signal unavailable: %s', ex)
+
+    def close(self):
+        if self._previous_handler is not None:
+            try:
+                signal(_PROFILE_SIGNAL, self._previous_handler)
+            except ValueError:
+                pass    # Not main thread
+        self._closed = True
+        self._signalled.set()
+        super().close()
+
+    def apply_event(self, event: Event):
+        """ Unused """
+
+    def get_commands(self) -> List[Command]:
+        return [Command('profile', self._apply_profile_command, ('SECONDS',), 1)] if self._channel_ids else []
+
+    def _apply_profile_command(self, event: Event, args: List[str]):
+        data: ChatCommandEventData = event.data
+        if str(data.channel_id) not in self._channel_ids:
+            self._reply('Profiling is not allowed in this channel!', event.publisher, data.channel_id)
+            return
+        try:
+            duration = float(args[0])
+        except ValueError:
+            duration = 0
+        if not 0 < duration <= self._settings.max_duration:
+            self._reply('Profile duration has to be between 0 and {} seconds!'.format(self._settings.max_duration), event.publisher, data.channel_id)
+            return
+        self._start(duration, event.publisher, data.channel_id)
+
+    def _await_signals(self):
+        while True:
+            self._signalled.wait()
+            if self._closed:
+                return
+            self._signalled.clear()
+            self._start(self._settings.signal_duration, None, None)
+
+    def _start(self, duration: float, publisher: Optional[str], channel_id: Union[str,int,None]):
+        if not self._running.acquire(blocking=False):   # pylint: disable=R1732
+            self._reply('Profiling is already running!', publisher, channel_id)
+            return
+        def run():
+            try:
+                stacks = _sample_stacks(duration, self._settings.interval)
+                filepath = self._write_stacks(stacks)
+                self._reply(_get_profile_summary(stacks, duration, filepath), publisher, channel_id)
+            except OSError as ex:
+                self._log.error('Profiling failed: %s', ex)
+            finally:
+                self._running.release()
+        Thread(target=run, name='botlet_profiler', daemon=True).start()
+
+    def _write_stacks(self, stacks: 'CollectionCounter[Tuple[str, ...]]') -> str:
+        # Collapsed stacks format for flamegraph tools
+        makedirs(self._output_dir, exist_ok=True)
+        filepath = path_join(self._output_dir, 'profile_{}.collapsed'.format(datetime.now().strftime('%Y%m%d_%H%M%S')))
+        with open(filepath, 'w', encoding='utf-8') as file:
+            for stack, count in stacks.most_common():
+                file.write('{} {}\n'.format(';'.join(stack), count))
+        return filepath
+
+    def _reply(self, text: str, publisher: Optional[str], channel_id: Union[str,int,None]):
+        self._publish_event_data(ChatOutputEventData(text, publisher, channel_id))
+
+
+# REGISTRATION
+def register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Event], None], config: Dict[str,Dict[str,str]], _env: Dict[str, str]):
+    """ Register local plugins to bot """
+    profiler_config = config.get('plugin.profiler', {})
+    workers.append(ProfilerPlugin(
+        'profiler', publish_event,
+        profiler_config.get('output_dir') or path_join(gettempdir(), 'botlet_profiles'),
+        {channel_id.strip() for channel_id in (profiler_config.get('channels') or '').split(',') if channel_id.strip()},
+        ProfilerSettings(
+            float(profiler_config.get('interval') or 0.01),
+            float(profiler_config.get('max_duration') or 300),
+            float(profiler_config.get('signal_duration') or 10)
+        )
+    ))
+
+
+# HELPERS
+def _sample_stacks(duration: float, interval: float) -> 'CollectionCounter[Tuple[str, ...]]':
+    # Count stacks (root first, prefixed by thread name) of all other threads periodically
+    stacks: 'CollectionCounter[Tuple[str, ...]]' = CollectionCounter()
+    own_ident = get_ident()
+    end = monotonic() + duration
+    while monotonic() < end:
+        thread_names = {thread.ident: thread.name for thread in enumerate_threads()}
+        for ident, frame in _current_frames().items():
+            if ident != own_ident:
+                stacks[(thread_names.get(ident, str(ident)),) + _get_frame_names(frame)] += 1
+        sleep(interval)
+    return stacks
+
+
+def _get_frame_names(frame: Optional[FrameType]) -> Tuple[str, ...]:
+    names = []
+    while frame:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(code.co_name, basename(code.co_filename), code.co_firstlineno).replace(';', ':'))
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+
+def _get_profile_summary(stacks: 'CollectionCounter[Tuple[str, ...]]', duration: float, filepath: str, top: int = 10) -> str:
+    # Hot frames by own samples (leaf of stack)
+    samples = max(sum(stacks.values()), 1)
+    hot_frames: 'CollectionCounter[str]' = CollectionCounter()
+    for stack, count in stacks.items():
+        hot_frames[stack[-1]] += count
+    return 'Profile of {:g}s ({} samples): {}\nTop frames:\n{}'.format(duration, samples, filepath, '\n'.join(
+        '{:.1f}% {}'.format(count * 100 / samples, frame)
+        for frame, count in hot_frames.most_common(top)
+    ))
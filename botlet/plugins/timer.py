@@ -1,17 +1,23 @@
-""" Plugins to run a timed task """
+""" Plugins to run timed tasks """
 from abc import ABC
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, Tuple
 
-from . import AbstractPlugin, AbstractThreadedPlugin, Event, EventData, StatusEventData
+from . import AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Event, EventData, StatusEventData
+from ..utils import SCHEDULER, CronSchedule
 
 
 # Plugin template for common resources & operations
-class _TimerPlugin(AbstractThreadedPlugin, ABC):
+class _TimerPlugin(AbstractPlugin, ABC):
+    EVENT_DATA_TYPES = ()
+
     def __init__(self, name: str, publish_event: Callable[[Event], None], interval: float, callback: Callable[[Callable[[EventData], None]], None]):
-        def run():
-            while not self._stopped.wait(interval):
-                callback(self._publish_event_data)
-        super().__init__(name, run, publish_event)
+        super().__init__(name, publish_event)
+        # Shared scheduler thread instead of own one
+        self._job = SCHEDULER.every(interval, lambda: callback(self._publish_event_data))
+
+    def close(self):
+        self._job.cancel()
+        super().close()
 
     def apply_event(self, event: Event):
         """ Unused """
@@ -23,6 +29,28 @@ class HeartbeatPlugin(_TimerPlugin):
         super().__init__(name, publish_event, interval, lambda publish_event_data: publish_event_data(StatusEventData(message)))
 
 
+class CronPlugin(AbstractPlugin):
+    """ Cron plugin class, publishing chat commands on schedules & their replies to default channels of all chats """
+    EVENT_DATA_TYPES = (ChatOutputEventData,)
+
+    def __init__(self, name: str, publish_event: Callable[[Event], None], commands: Dict[str, Tuple[CronSchedule, str]]):
+        super().__init__(name, publish_event)
+        self._jobs = [
+            SCHEDULER.cron(schedule, lambda command=command, command_name=command_name: self._publish_event_data(ChatCommandEventData(command, command_name)))
+            for command_name, (schedule, command) in commands.items()
+        ]
+
+    def close(self):
+        for job in self._jobs:
+            job.cancel()
+        super().close()
+
+    def apply_event(self, event: Event):
+        data: ChatOutputEventData = event.data
+        if data.target_publisher == self.name:
+            self._publish_event_data(ChatOutputEventData(data.text, None, None))
+
+
 def register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Event], None], config: Dict[str,Dict[str,str]], _env: Dict[str, str]):
     """ Register local plugins to bot """
     heartbeat = config.get('plugin.heartbeat', {})
@@ -30,3 +58,11 @@ def register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Eve
     heartbeat_message = heartbeat.get('message')
     if heartbeat_interval and heartbeat_message:
         workers.append(HeartbeatPlugin('heartbeat', publish_event, float(heartbeat_interval), heartbeat_message))
+    cron_commands = {}
+    for command_name, entry in config.get('plugin.cron', {}).items():
+        fields = entry.split(None, 5)
+        if len(fields) < 6:
+            raise ValueError('Cron entry "{}" requires schedule and command!'.format(command_name))
+        cron_commands[command_name] = (CronSchedule(' '.join(fields[:5])), fields[5])
+    if cron_commands:
+        workers.append(CronPlugin('cron', publish_event, cron_commands))
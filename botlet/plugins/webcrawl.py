@@ -1,51 +1,84 @@
 """ Plugins to analyze websites """
+from asyncio import Lock as AsyncLock, gather, get_running_loop, sleep as async_sleep
+from codecs import getincrementaldecoder
 from concurrent.futures import ThreadPoolExecutor
-from dataclasses import dataclass
-from datetime import date
-from functools import lru_cache
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timedelta
 from html.parser import HTMLParser
-from http.client import HTTPResponse
+from json import dump as json_dump, load as json_load
 from logging import getLogger
-from urllib.error import URLError
-from urllib.request import Request, urlopen
-from threading import Thread
-from typing import Callable, Dict, List, Optional, Tuple
+from os import replace
+from os.path import isfile, join as path_join
+from tempfile import gettempdir
+from threading import Lock
+from time import monotonic, perf_counter, time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, TypeVar
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
 
-from . import AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Event
+from . import AbstractAsyncPlugin, AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Command, Event
+from ..utils import METRICS, HttpFetcher
 
 
 # PLUGINS
-class AnimeBirthdaysPlugin(AbstractPlugin):
+class AnimeBirthdaysPlugin(AbstractAsyncPlugin):
     """ Anime birthdays plugin class """
-    def __init__(self, name: str, publish_event: Callable[[Event], None]):
-        super().__init__(name, publish_event)
+    EVENT_DATA_TYPES = ()
+
+    def __init__(self, name: str, publish_event: Callable[[Event], None], cache: '_BirthdayCharactersCache', prefill_index: Optional['_CharacterAnimeIndex'] = None):
+        self._cache = cache
+        async def run():
+            # Crawl anime of all characters once, so daily requests need birthday pages only
+            if prefill_index is not None:
+                try:
+                    await _prefill_anime_index(prefill_index, self._stopped.is_set)
+                except URLError as ex:
+                    self._log.error('Prefilling anime index failed: %s', ex)
+            # Pre-warm cache shortly after midnight
+            while not await self._wait_stopped(_get_seconds_until_midnight() + 300):
+                try:
+                    await self._cache.get(date.today())
+                except URLError as ex:
+                    self._log.error('Pre-warming characters failed: %s', ex)
+        super().__init__(name, run, publish_event)
 
     def apply_event(self, event: Event):
-        # Is valid plugin command?
-        if isinstance(event.data, ChatCommandEventData):
-            data: ChatCommandEventData = event.data
-            if data.command == 'help':
-                self._publish_event_data(ChatOutputEventData('Command: anime_birthdays', event.publisher, data.channel_id))
-            elif data.command == 'anime_birthdays':
-                # Show characters with todays birthday from anisearch.com
-                def run():
-                    try:
-                        self._publish_event_data(ChatOutputEventData(
-                            'Anime birthdays:\n' + '\n'.join(map(
-                                lambda character: '{} ({}) [{}]:\n{}'.format(character.name, character.anime, character.rating, character.url),
-                                _get_anisearch_birthday_characters()
-                            )),
-                            event.publisher, data.channel_id
-                        ))
-                    except URLError as ex:
-                        self._log.error('Loading characters failed: %s', ex)
-                Thread(target=run, daemon=True).start()
+        """ Unused """
+
+    def get_commands(self) -> List[Command]:
+        return [Command('anime_birthdays', self._apply_anime_birthdays_command)]
+
+    def _apply_anime_birthdays_command(self, event: Event, _args: List[str]):
+        data: ChatCommandEventData = event.data
+        # Show characters with todays birthday from anisearch.com
+        async def run():
+            try:
+                self._publish_event_data(ChatOutputEventData(
+                    'Anime birthdays:\n' + '\n'.join(map(
+                        lambda character: '{} ({}) [{}]:\n{}'.format(character.name, character.anime, character.rating, character.url),
+                        await self._cache.get(date.today())
+                    )),
+                    event.publisher, data.channel_id
+                ))
+            except URLError as ex:
+                self._log.error('Loading characters failed: %s', ex)
+        self._run_coroutine(run())
 
 
 # REGISTRATION
-def register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Event], None], _config: Dict[str,Dict[str,str]], _env: Dict[str, str]):
+def register_plugins(workers: List[AbstractPlugin], publish_event: Callable[[Event], None], config: Dict[str,Dict[str,str]], _env: Dict[str, str]):
     """ Register local plugins to bot """
-    workers.append(AnimeBirthdaysPlugin('anime_birthdays', publish_event))
+    anime_config = config.get('plugin.anime_birthdays', {})
+    index = _CharacterAnimeIndex(
+        anime_config.get('index_file') or path_join(gettempdir(), 'botlet_anime_index.json'),
+        float(anime_config.get('index_ttl') or 180) * 86400,
+        float(anime_config.get('index_negative_ttl') or 30) * 86400
+    )
+    workers.append(AnimeBirthdaysPlugin(
+        'anime_birthdays', publish_event,
+        _BirthdayCharactersCache(anime_config.get('cache_file') or path_join(gettempdir(), 'botlet_anime_birthdays.json'), index),
+        index if (anime_config.get('index_prefill') or '').lower() in ('1', 'true', 'yes', 'on') else None
+    ))
 
 
 # HELPERS
@@ -57,30 +90,41 @@ class _AnisearchCharacter:
     url: str
 
 
-class _AnisearchBirthdayCharactersParser(HTMLParser):
-    def __init__(self, day: int):
+class _AnisearchParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self._complete = False
+        self._log = getLogger(__name__)
+
+    def is_complete(self) -> bool:
+        """ Get whether needed data was parsed, so remaining input can be skipped """
+        return self._complete
+
+    def error(self, message: str):
+        """ Log parse error instead of raising (removed from base class by python 3.10) """
+        self._log.error(message)
+
+
+class _AnisearchBirthdayCharactersParser(_AnisearchParser):
+    def __init__(self, day: Optional[int]):
         # Initialization
         super().__init__()
-        self._day = day
+        self._day = day # All days of month if None
         self._rating_suffix = ' ❤'  # Text node ends with unicode heart symbol
         # Results
         self._characters: List[_AnisearchCharacter] = []
-        self._log = getLogger(__name__)
         # Parser state
-        self._section_today = False
+        self._section_day = False
 
     def get_characters(self) -> List[_AnisearchCharacter]:
         """ Get parsed characters """
         return self._characters
 
-    def error(self, message: str):
-        self._log.error(message)
-
     def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]):
         attrs_dict = dict(attrs)
-        if tag == 'section' and attrs_dict.get('id') == 'day-' + str(self._day):
-            self._section_today = True
-        elif self._section_today and tag == 'a' and 'data-title' in attrs_dict and 'href' in attrs_dict:
+        if tag == 'section' and (attrs_dict.get('id') == 'day-' + str(self._day) or self._day is None and (attrs_dict.get('id') or '').startswith('day-')):
+            self._section_day = True
+        elif self._section_day and tag == 'a' and 'data-title' in attrs_dict and 'href' in attrs_dict:
             self._characters.append(_AnisearchCharacter(
                 attrs_dict['data-title'].replace('Character: ', '').title(),
                 None,
@@ -89,66 +133,294 @@ class _AnisearchBirthdayCharactersParser(HTMLParser):
             ))
 
     def handle_endtag(self, tag: str):
-        if tag == 'section':
-            self._section_today = False
+        if tag == 'section' and self._section_day:
+            self._section_day = False
+            self._complete = self._day is not None
 
     def handle_data(self, data: str):
-        if self._section_today and self._characters and data.endswith(self._rating_suffix):
+        if self._section_day and self._characters and data.endswith(self._rating_suffix):
             try:
                 self._characters[-1].rating =  int(data.replace(self._rating_suffix, ''))
             except ValueError as ex:
                 self._log.error('Rating for %s: %s', self._characters[-1], ex)
 
 
-class _AnisearchCharacterAnimeParser(HTMLParser):
+class _AnisearchCharacterAnimeParser(_AnisearchParser):
     def __init__(self):
         super().__init__()
         self._anime = None
-        self._log = getLogger(__name__)
 
     def get_anime(self) -> str:
         """ Get parsed anime """
         return self._anime
 
-    def error(self, message: str):
-        self._log.error(message)
-
     def handle_starttag(self, tag: str, attrs: List[Tuple[str, str]]):
         if tag == 'a':
             anime = [attr[1].replace('Anime: ', '') for attr in attrs if attr[0] == 'data-title' and attr[1].startswith('Anime: ')]
             if anime:
                 self._anime = anime[0] # Always overrides, results in last / oldest anime
 
+    def handle_endtag(self, tag: str):
+        # Anime links are listed in one section, so its end finishes search
+        if tag == 'section' and self._anime:
+            self._complete = True
+
+
+class _BirthdayCharactersCache:
+    """ Characters by birthday, persisted to file and expiring at midnight """
+    def __init__(self, filepath: str, index: Optional['_CharacterAnimeIndex'] = None):
+        self._filepath = filepath
+        self._index = index
+        self._days: Dict[str, List[_AnisearchCharacter]] = {}
+        self._lock: Optional[AsyncLock] = None  # Created on event loop
+        self._log = getLogger(__name__)
+        self._load()
+
+    async def get(self, birthday: date) -> List[_AnisearchCharacter]:
+        """ Get characters from cache or crawl them (once for concurrent requests, partial results aren't cached) """
+        if self._lock is None:
+            self._lock = AsyncLock()
+        async with self._lock:
+            characters = self._days.get(birthday.isoformat())
+            if characters is None:
+                characters, complete = await _get_anisearch_birthday_characters(birthday, self._index)
+                if complete:
+                    # Keep today & future days only
+                    today = date.today().isoformat()
+                    self._days = {day: day_characters for day, day_characters in self._days.items() if day >= today}
+                    self._days[birthday.isoformat()] = characters
+                    self._save()
+            return characters
+
+    def _load(self):
+        if isfile(self._filepath):
+            try:
+                with open(self._filepath, encoding='utf-8') as file:
+                    self._days = {
+                        day: [_AnisearchCharacter(**character) for character in characters]
+                        for day, characters in json_load(file).items()
+                        if day >= date.today().isoformat()
+                    }
+            except (OSError, ValueError, TypeError) as ex:
+                self._log.warning('Loading characters cache failed: %s', ex)
+
+    def _save(self):
+        try:
+            with open(self._filepath + '.tmp', 'w', encoding='utf-8') as file:
+                json_dump({
+                    day: [asdict(character) for character in characters]
+                    for day, characters in self._days.items()
+                }, file)
+            replace(self._filepath + '.tmp', self._filepath)
+        except OSError as ex:
+            self._log.warning('Saving characters cache failed: %s', ex)
+
+
+# Metrics of anime index
+_INDEX_LOOKUPS = METRICS.counter('botlet_anime_index_lookups_total', 'Lookups of character anime index', ('result',))
+
+
+class _CharacterAnimeIndex:
+    """ Anime by character url, persisted to file and expiring after long time (shorter for known non-anime characters) """
+    def __init__(self, filepath: str, ttl: float, negative_ttl: float):
+        self._filepath = filepath
+        self._ttl = ttl # Seconds
+        self._negative_ttl = negative_ttl
+        self._entries: Dict[str, Tuple[str, float]] = {} # Anime (empty for none) & time of crawl by character url
+        self._changed = False
+        self._log = getLogger(__name__)
+        self._load()
 
-@lru_cache(7)
-def _get_anisearch_birthday_characters(birthday: date = date.today()) -> List[_AnisearchCharacter]:
-    user_agent_headers = {'User-Agent': 'Mozilla/5.0'}  # Hack to prevent websites blocking bots
-    http_response: HTTPResponse = None  # Typing for url responses of http requests
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, url: str) -> Optional[str]:
+        """ Get anime of character, empty for non-anime character or None if unknown """
+        entry = self._entries.get(url)
+        if entry and not self._is_expired(entry):
+            _INDEX_LOOKUPS.inc('hit')
+            return entry[0]
+        _INDEX_LOOKUPS.inc('miss')
+        return None
+
+    def set(self, url: str, anime: Optional[str]):
+        """ Remember anime of character (None for non-anime character) """
+        self._entries[url] = (anime or '', time())
+        self._changed = True
+
+    def save(self):
+        """ Persist changes to file """
+        if self._changed:
+            try:
+                with open(self._filepath + '.tmp', 'w', encoding='utf-8') as file:
+                    json_dump({url: list(entry) for url, entry in self._entries.items() if not self._is_expired(entry)}, file, separators=(',', ':'))
+                replace(self._filepath + '.tmp', self._filepath)
+                self._changed = False
+            except OSError as ex:
+                self._log.warning('Saving anime index failed: %s', ex)
+
+    def _is_expired(self, entry: Tuple[str, float]) -> bool:
+        return entry[1] + (self._ttl if entry[0] else self._negative_ttl) < time()
+
+    def _load(self):
+        if isfile(self._filepath):
+            try:
+                with open(self._filepath, encoding='utf-8') as file:
+                    self._entries = {url: (str(anime), float(crawl_time)) for url, (anime, crawl_time) in json_load(file).items()}
+            except (OSError, ValueError, TypeError) as ex:
+                self._log.warning('Loading anime index failed: %s', ex)
+
+
+def _get_seconds_until_midnight() -> float:
+    now = datetime.now()
+    return (datetime.combine(now.date() + timedelta(days=1), datetime.min.time()) - now).total_seconds()
+
+
+# Shared http client for websites
+_HTTP_FETCHER = HttpFetcher(
+    {'User-Agent': 'Mozilla/5.0'},  # Hack to prevent websites blocking bots
+    timeout=30
+)
+
+
+_ParserT = TypeVar('_ParserT', bound=_AnisearchParser)
+
+
+# Metrics of crawled pages
+_CRAWL_SECONDS = METRICS.histogram('botlet_crawl_seconds', 'Duration of page crawls including retries', ('host', 'result'))
+_CRAWL_RETRIES = METRICS.counter('botlet_crawl_retries_total', 'Retried page crawls', ('host',))
+
+
+class _CrawlSettings(NamedTuple):
+    max_concurrency: int = 8
+    host_delay: float = 0.2 # Seconds between requests to same host
+    retries: int = 2
+    backoff: float = 1  # Seconds before first retry, doubled by each one
+
+
+class _Crawler:
+    """ Asynchronous crawl engine with global concurrency cap by shared pool, politeness delay per host and retries """
+    def __init__(self, fetcher: HttpFetcher, settings: _CrawlSettings = _CrawlSettings()):
+        self._fetcher = fetcher
+        self._settings = settings
+        self._executor = ThreadPoolExecutor(settings.max_concurrency, thread_name_prefix='crawler')
+        self._host_slots: Dict[str, float] = {}   # Earliest time of next request per host
+        self._lock = Lock()
+        self._log = getLogger(__name__)
+
+    async def crawl(self, url: str, create_parser: Callable[[], _ParserT]) -> _ParserT:
+        """ Parse website by new parser, raises URLError if all attempts failed """
+        host = urlsplit(url).hostname or ''
+        start = perf_counter()
+        attempt = 0
+        while True:
+            await async_sleep(self._reserve_host_slot(url))
+            parser = create_parser()
+            try:
+                await get_running_loop().run_in_executor(self._executor, self._feed_parser, parser, url)
+                _CRAWL_SECONDS.observe(perf_counter() - start, host, 'success')
+                return parser
+            except HTTPError as ex:
+                # Client errors don't change by retry
+                self._check_retry(url, start, ex, attempt < self._settings.retries and (ex.code >= 500 or ex.code == 429))
+            except URLError as ex:
+                self._check_retry(url, start, ex, attempt < self._settings.retries)
+            await async_sleep(self._settings.backoff * 2 ** attempt)
+            attempt += 1
+
+    def _check_retry(self, url: str, start: float, error: URLError, retry: bool):
+        # Raise error of final attempt, otherwise count retry
+        host = urlsplit(url).hostname or ''
+        if not retry:
+            _CRAWL_SECONDS.observe(perf_counter() - start, host, 'failure')
+            raise error
+        self._log.warning('Crawling %s failed, retry: %s', url, error)
+        _CRAWL_RETRIES.inc(host)
+
+    def _reserve_host_slot(self, url: str) -> float:
+        # Space requests to same host by politeness delay, return seconds to wait
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._host_slots.get(host, now))
+            self._host_slots[host] = slot + self._settings.host_delay
+            if len(self._host_slots) > 1024:
+                self._host_slots = {host: host_slot for host, host_slot in self._host_slots.items() if host_slot > now}
+        return slot - now
+
+    def _feed_parser(self, parser: _AnisearchParser, url: str):
+        # Stream website into parser until it has all needed data
+        decoder = getincrementaldecoder('utf-8')()
+        chunks = self._fetcher.iter_chunks(url)
+        try:
+            for chunk in chunks:
+                parser.feed(decoder.decode(chunk))
+                if parser.is_complete():
+                    break
+            else:
+                parser.feed(decoder.decode(b'', True))
+        finally:
+            chunks.close()
+
+
+# Shared crawler for websites
+_CRAWLER = _Crawler(_HTTP_FETCHER)
+
+
+# Birthdays page of anisearch by month
+_ANISEARCH_BIRTHDAYS_URL = 'http://www.anisearch.com/character/birthdays?month={}'
+
+
+async def _get_anisearch_birthday_characters(birthday: date, index: Optional[_CharacterAnimeIndex] = None) -> Tuple[List[_AnisearchCharacter], bool]:
     # Find characters by birthday
-    with urlopen(Request(
-        'http://www.anisearch.com/character/birthdays?month=' + str(birthday.month),
-        headers=user_agent_headers
-    )) as http_response:
-        parser = _AnisearchBirthdayCharactersParser(birthday.day)
-        parser.feed(str(http_response.read(), 'utf-8'))
-        characters = parser.get_characters()
-        # Add anime to characters
-        def add_anime(character: _AnisearchCharacter):
-            with urlopen(Request(
-                character.url,
-                headers=user_agent_headers
-            )) as http_response:
-                parser = _AnisearchCharacterAnimeParser()
-                parser.feed(str(http_response.read(), 'utf-8'))
-                character.anime = parser.get_anime()
-        with ThreadPoolExecutor() as pool:
-            pool.map(add_anime, characters)
-        # Restrict to anime characters and sort by rating
-        return list(sorted(
-            filter(
-                lambda character: character.anime,
-                characters
-            ),
-            key=lambda c: c.rating,
-            reverse=True
-        ))
+    parser = await _CRAWLER.crawl(_ANISEARCH_BIRTHDAYS_URL.format(birthday.month), lambda: _AnisearchBirthdayCharactersParser(birthday.day))
+    characters = parser.get_characters()
+    # Add anime to characters by index or their pages, leave out ones of failed pages
+    complete = True
+    unknown_characters = []
+    for character in characters:
+        anime = index.get(character.url) if index is not None else None
+        if anime is None:
+            unknown_characters.append(character)
+        else:
+            character.anime = anime or None
+    for character, result in zip(unknown_characters, await gather(
+            *(_CRAWLER.crawl(character.url, _AnisearchCharacterAnimeParser) for character in unknown_characters),
+            return_exceptions=True
+        )):
+        if isinstance(result, URLError):
+            getLogger(__name__).warning('Crawling anime of %s failed: %s', character.name, result)
+            complete = False
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            character.anime = result.get_anime()
+            if index is not None:
+                index.set(character.url, character.anime)
+    if index is not None:
+        index.save()
+    # Restrict to anime characters and sort by rating
+    return list(sorted(
+        filter(
+            lambda character: character.anime,
+            characters
+        ),
+        key=lambda c: c.rating,
+        reverse=True
+    )), complete
+
+
+async def _prefill_anime_index(index: _CharacterAnimeIndex, is_stopped: Callable[[], bool]):
+    # Crawl unknown characters of all months, one page at a time to leave crawler slots for requests
+    for month in range(1, 13):
+        parser = await _CRAWLER.crawl(_ANISEARCH_BIRTHDAYS_URL.format(month), lambda: _AnisearchBirthdayCharactersParser(None))
+        for character in parser.get_characters():
+            if is_stopped():
+                index.save()
+                return
+            if index.get(character.url) is None:
+                try:
+                    index.set(character.url, (await _CRAWLER.crawl(character.url, _AnisearchCharacterAnimeParser)).get_anime())
+                except URLError as ex:
+                    getLogger(__name__).warning('Crawling anime of %s failed: %s', character.name, ex)
+        index.save()
@@ -1,3 +1,9 @@
 """ Internal utilities """
-from .queue import SafeQueue
-from .tempfile import SafeTemporaryDirectory
+from .cache import LoadingCache, TtlCache
+from .executor import BoundedExecutor
+from .http import HttpFetcher
+from .metrics import METRICS, Counter, Gauge, Histogram, HistogramChild, MetricsRegistry, MetricsServer
+from .pool import ShardedPool
+from .queue import OverflowPolicy, SafeQueue, Watermarks
+from .scheduler import SCHEDULER, CronSchedule, ScheduledJob, Scheduler
+from .tempfile import SafeTemporaryDirectory, safe_rmtree
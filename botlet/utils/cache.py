@@ -0,0 +1,89 @@
+""" Convenience caches """
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock, Thread
+from time import monotonic
+from typing import Callable, Dict, Generic, Hashable, Optional, Tuple, TypeVar
+
+
+# Any type variables for following generics
+K = TypeVar('K', bound=Hashable)    # pylint: disable=C0103
+V = TypeVar('V')    # pylint: disable=C0103
+
+
+class TtlCache(Generic[K, V]):
+    """ Thread-safe cache with entries expiring after time-to-live (in seconds) """
+    def __init__(self, ttl: float, maxsize: int = 256):
+        self._ttl = ttl
+        self._maxsize = maxsize
+        self._entries: 'OrderedDict[K, Tuple[float, V]]' = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K) -> Optional[V]:
+        """ Get value of key if cached and not expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= monotonic():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def put(self, key: K, value: V):
+        """ Set value of key, evicting oldest entries on full cache """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (monotonic() + self._ttl, value)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+
+class LoadingCache(Generic[K, V]):
+    """ Thread-safe cache loading values once for concurrent requests and serving stale values while reloading in background """
+    def __init__(self, load: Callable[[K], V], ttl: float, stale_ttl: float = 0, maxsize: int = 256):
+        self._load = load
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._maxsize = maxsize
+        self._entries: 'OrderedDict[K, Tuple[float, V]]' = OrderedDict()
+        self._loads: Dict[K, Future] = {}
+        self._lock = Lock()
+
+    def get(self, key: K) -> V:
+        """ Get value of key from cache or by (shared) load, raises load exceptions """
+        with self._lock:
+            entry = self._entries.get(key)
+            age = monotonic() - entry[0] if entry else None
+            if age is not None and age < self._ttl:
+                return entry[1]
+            future = self._loads.get(key)
+            is_loader = future is None
+            if is_loader:
+                future = self._loads[key] = Future()
+            if age is not None and age < self._ttl + self._stale_ttl:
+                # Serve stale value, reload in background
+                if is_loader:
+                    Thread(target=self._run_load, args=(key, future), daemon=True).start()
+                return entry[1]
+        if is_loader:
+            self._run_load(key, future)
+        return future.result()
+
+    def _run_load(self, key: K, future: Future):
+        try:
+            value = self._load(key)
+            with self._lock:
+                self._entries.pop(key, None)
+                self._entries[key] = (monotonic(), value)
+                while len(self._entries) > self._maxsize:
+                    self._entries.popitem(last=False)
+            future.set_result(value)
+        except Exception as ex:    # pylint: disable=W0703
+            future.set_exception(ex)
+        finally:
+            with self._lock:
+                del self._loads[key]
@@ -0,0 +1,33 @@
+""" Convenience executors """
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore
+from typing import Any, Callable, Optional
+
+
+class BoundedExecutor:
+    """ Thread pool with limited number of waiting tasks """
+    def __init__(self, max_workers: int, max_queue: int = 0, thread_name_prefix: str = ''):
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix)   # pylint: disable=R1732 # Owner calls shutdown
+        self._slots = BoundedSemaphore(max_workers + max_queue)
+
+    def submit(self, func: Callable[[], Any]) -> Optional[Future]:
+        """ Schedules a call, return its future on success or None on already full """
+        if not self._slots.acquire(blocking=False):   # pylint: disable=R1732 # Released when call is done
+            return None
+        try:
+            future = self._pool.submit(func)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self, wait: bool = True):
+        """ Stops accepting calls, frees resources after running ones """
+        self._pool.shutdown(wait)
+
+    def __enter__(self) -> 'BoundedExecutor':
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
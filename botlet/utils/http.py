@@ -0,0 +1,186 @@
+""" Convenience http client """
+from collections import OrderedDict
+from http.client import HTTPConnection, HTTPException, HTTPResponse, HTTPSConnection
+from threading import BoundedSemaphore, Lock
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.error import HTTPError, URLError
+from urllib.parse import urljoin, urlsplit
+from zlib import MAX_WBITS, decompressobj, error as zlib_error
+
+from .metrics import METRICS
+
+
+# Connection pool key: scheme, host & port
+_HostKey = Tuple[str, str, int]
+
+
+# Metrics of requests
+_RESPONSE_SECONDS = METRICS.histogram('botlet_http_response_seconds', 'Duration of http requests until response head', ('host',))
+_RESPONSES = METRICS.counter('botlet_http_responses_total', 'Received http responses', ('host', 'status'))
+
+
+# Response for conditional requests
+class _CachedResponse(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    body: bytes
+
+
+class HttpFetcher:
+    """ Thread-safe http client with keep-alive connections per host, compression and revalidation of cached responses """
+    def __init__(self, headers: Optional[Dict[str, str]] = None, timeout: float = 30, max_host_connections: int = 4, max_cached: int = 256, max_redirects: int = 5):
+        self._headers = dict(headers or {}, **{'Accept-Encoding': 'gzip'})
+        self._timeout = timeout
+        self._max_cached = max_cached
+        self._max_redirects = max_redirects
+        self._connections = _ConnectionPool(max_host_connections)
+        self._cache: 'OrderedDict[str, _CachedResponse]' = OrderedDict()
+        self._lock = Lock()
+
+    def fetch(self, url: str, timeout: Optional[float] = None) -> bytes:
+        """ Get response body of url, raises URLError on failure """
+        return b''.join(self.iter_chunks(url, timeout))
+
+    def iter_chunks(self, url: str, timeout: Optional[float] = None, chunk_size: int = 16384) -> Iterator[bytes]:
+        """ Get response body of url by chunks, raises URLError on failure (closing iterator early drops connection) """
+        for _ in range(self._max_redirects + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.hostname:
+                raise URLError('Unsupported url: ' + url)
+            host_key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+            cached, headers = self._get_revalidation(url)
+            with self._connections.get_host_slot(host_key):
+                with _RESPONSE_SECONDS.time(host_key[1]):
+                    connection, response = self._connections.open(host_key, (parts.path or '/') + ('?' + parts.query if parts.query else ''), headers, timeout or self._timeout)
+                _RESPONSES.inc(host_key[1], str(response.status))
+                completed = False
+                try:
+                    # Evaluate response
+                    location = response.getheader('Location')
+                    if response.status in (301, 302, 303, 307, 308) and location:
+                        completed = _drain(response)
+                        url = urljoin(url, location)
+                    elif response.status == 304 and cached:
+                        completed = _drain(response)
+                        yield cached.body
+                        return
+                    elif response.status >= 400:
+                        completed = _drain(response)
+                        raise HTTPError(url, response.status, response.reason, response.headers, None)
+                    else:
+                        yield from self._stream_body(url, response, chunk_size)
+                        completed = True
+                        return
+                finally:
+                    self._connections.release(host_key, connection, response, completed)
+        raise URLError('Too many redirects: ' + url)
+
+    def close(self):
+        """ Close idle connections """
+        self._connections.close()
+
+    def _get_revalidation(self, url: str) -> Tuple[Optional[_CachedResponse], Dict[str, str]]:
+        # Cached response & request headers to revalidate it
+        headers = dict(self._headers)
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached:
+            if cached.etag:
+                headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                headers['If-Modified-Since'] = cached.last_modified
+        return cached, headers
+
+    def _stream_body(self, url: str, response: HTTPResponse, chunk_size: int) -> Iterator[bytes]:
+        # Stream decompressed body, remember it for revalidation
+        decompressor = decompressobj(16 + MAX_WBITS) if response.getheader('Content-Encoding') == 'gzip' else None
+        etag = response.getheader('ETag')
+        last_modified = response.getheader('Last-Modified')
+        body_chunks: Optional[List[bytes]] = [] if etag or last_modified else None
+        while True:
+            try:
+                data = response.read(chunk_size)
+                chunk = (decompressor.decompress(data) if data else decompressor.flush()) if decompressor else data
+            except (OSError, HTTPException, zlib_error) as ex:
+                raise URLError(ex) from ex
+            if chunk:
+                if body_chunks is not None:
+                    body_chunks.append(chunk)
+                yield chunk
+            if not data:
+                break
+        if body_chunks is not None:
+            self._cache_response(url, _CachedResponse(etag, last_modified, b''.join(body_chunks)))
+
+    def _cache_response(self, url: str, response: _CachedResponse):
+        with self._lock:
+            self._cache.pop(url, None)
+            self._cache[url] = response
+            while len(self._cache) > self._max_cached:
+                self._cache.popitem(last=False)
+
+
+class _ConnectionPool:
+    """ Idle keep-alive connections & limit of concurrent ones per host """
+    def __init__(self, max_host_connections: int):
+        self._max_host_connections = max_host_connections
+        self._connections: Dict[_HostKey, List[HTTPConnection]] = {}    # Idle ones
+        self._host_slots: Dict[_HostKey, BoundedSemaphore] = {}
+        self._lock = Lock()
+
+    def get_host_slot(self, host_key: _HostKey) -> BoundedSemaphore:
+        """ Get semaphore limiting concurrent connections to host """
+        with self._lock:
+            host_slot = self._host_slots.get(host_key)
+            if not host_slot:
+                host_slot = self._host_slots[host_key] = BoundedSemaphore(self._max_host_connections)
+            return host_slot
+
+    def open(self, host_key: _HostKey, path: str, headers: Dict[str, str], timeout: float) -> Tuple[HTTPConnection, HTTPResponse]:
+        """ Send request by idle or new connection, raises URLError on failure """
+        with self._lock:
+            idle_connections = self._connections.get(host_key)
+            idle_connection = idle_connections.pop() if idle_connections else None
+        # Reused connection could be closed by server meanwhile, so retry with new one
+        error = None
+        for reused_connection in (idle_connection, None) if idle_connection else (None,):
+            if reused_connection:
+                connection = reused_connection
+                connection.timeout = timeout
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+            else:
+                connection_class = HTTPSConnection if host_key[0] == 'https' else HTTPConnection
+                connection = connection_class(host_key[1], host_key[2], timeout=timeout)
+            try:
+                connection.request('GET', path, headers=headers)
+                return connection, connection.getresponse()
+            except (OSError, HTTPException) as ex:
+                connection.close()
+                error = ex
+        raise URLError(error)
+
+    def release(self, host_key: _HostKey, connection: HTTPConnection, response: HTTPResponse, completed: bool):
+        """ Keep connection alive for next request if response was read completely """
+        if completed and not response.will_close:
+            with self._lock:
+                self._connections.setdefault(host_key, []).append(connection)
+        else:
+            connection.close()
+
+    def close(self):
+        """ Close idle connections """
+        with self._lock:
+            for connections in self._connections.values():
+                for connection in connections:
+                    connection.close()
+            self._connections.clear()
+
+
+def _drain(response: HTTPResponse) -> bool:
+    # Read unused body, so connection can be reused, raises URLError on failure
+    try:
+        response.read()
+    except (OSError, HTTPException) as ex:
+        raise URLError(ex) from ex
+    return True
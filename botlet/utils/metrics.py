@@ -0,0 +1,226 @@
+""" Convenience metrics, exposed in Prometheus text format """
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Type, TypeVar
+
+
+# Values of metric labels in order of label names
+_LabelValues = Tuple[str, ...]
+
+
+class _Metric:
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values: Dict[_LabelValues, float] = {}
+        self._trackers: Dict[_LabelValues, Callable[[], float]] = {}
+        self._lock = Lock()
+
+    def track(self, get_value: Callable[[], float], *label_values: str):
+        """ Get value by callback on rendering (f.e. queue depth) """
+        with self._lock:
+            self._trackers[label_values] = get_value
+
+    def untrack(self, *label_values: str):
+        """ Remove value callback """
+        with self._lock:
+            self._trackers.pop(label_values, None)
+
+    def render(self) -> Iterator[str]:
+        """ Get lines of Prometheus text format """
+        yield '# HELP {} {}'.format(self.name, self.description)
+        yield '# TYPE {} {}'.format(self.name, self.TYPE)
+        with self._lock:
+            values = dict(self._values)
+            trackers = dict(self._trackers)
+        for label_values, get_value in trackers.items():
+            values[label_values] = get_value()
+        for label_values, value in sorted(values.items()):
+            yield '{}{} {}'.format(self.name, self._format_labels(label_values), _format_value(value))
+
+    def _format_labels(self, label_values: _LabelValues, extra_label: Optional[Tuple[str, str]] = None) -> str:
+        labels = list(zip(self.label_names, label_values)) + ([extra_label] if extra_label else [])
+        return '{' + ','.join('{}="{}"'.format(name, _escape_label(value)) for name, value in labels) + '}' if labels else ''
+
+
+class Counter(_Metric):
+    """ Monotonic increasing value per labels """
+    TYPE = 'counter'
+
+    def inc(self, *label_values: str, amount: float = 1):
+        """ Add amount to value of labels """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(_Metric):
+    """ Current value per labels """
+    TYPE = 'gauge'
+
+    def set(self, value: float, *label_values: str):
+        """ Replace value of labels """
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values (f.e. durations in seconds) per labels """
+    TYPE = 'histogram'
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, description, label_names)
+        self._buckets = tuple(sorted(buckets))
+        self._children: Dict[_LabelValues, HistogramChild] = {}
+
+    def labels(self, *label_values: str) -> 'HistogramChild':
+        """ Get observations of labels (keep it for hot paths to skip lookups) """
+        child = self._children.get(label_values)
+        if not child:
+            with self._lock:
+                child = self._children.setdefault(label_values, HistogramChild(self._buckets))
+        return child
+
+    def observe(self, value: float, *label_values: str):
+        """ Count value into bucket of labels """
+        self.labels(*label_values).observe(value)
+
+    def time(self, *label_values: str) -> '_Timer':
+        """ Observe duration of context """
+        return _Timer(self.labels(*label_values))
+
+    def render(self) -> Iterator[str]:
+        yield '# HELP {} {}'.format(self.name, self.description)
+        yield '# TYPE {} {}'.format(self.name, self.TYPE)
+        with self._lock:
+            children = dict(self._children)
+        for label_values, (counts, total) in sorted((label_values, child.get_observations()) for label_values, child in children.items()):
+            count = 0
+            for bound, bucket_count in zip(self._buckets + (float('inf'),), counts):
+                count += bucket_count
+                yield '{}_bucket{} {}'.format(self.name, self._format_labels(label_values, ('le', _format_value(bound))), count)
+            yield '{}_sum{} {}'.format(self.name, self._format_labels(label_values), _format_value(total))
+            yield '{}_count{} {}'.format(self.name, self._format_labels(label_values), count)
+
+
+class HistogramChild:
+    """ Observations of histogram for one set of labels """
+    __slots__ = ('_buckets', '_counts', '_sum', '_lock')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)   # +Inf last
+        self._sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float):
+        """ Count value into bucket """
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def get_observations(self) -> Tuple[List[int], float]:
+        """ Get counts per bucket & sum of values """
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class _Timer:
+    def __init__(self, histogram_child: HistogramChild):
+        self._histogram_child = histogram_child
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *_exc_info):
+        self._histogram_child.observe(perf_counter() - self._start)
+
+
+# Any metric type for following generics
+M = TypeVar('M', bound=_Metric)  # pylint: disable=C0103
+
+
+class MetricsRegistry:
+    """ Thread-safe collection of metrics by name """
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = Lock()
+
+    def counter(self, name: str, description: str, label_names: Sequence[str] = ()) -> Counter:
+        """ Get or create counter """
+        return self._get(Counter, name, description, label_names)
+
+    def gauge(self, name: str, description: str, label_names: Sequence[str] = ()) -> Gauge:
+        """ Get or create gauge """
+        return self._get(Gauge, name, description, label_names)
+
+    def histogram(self, name: str, description: str, label_names: Sequence[str] = ()) -> Histogram:
+        """ Get or create histogram """
+        return self._get(Histogram, name, description, label_names)
+
+    def render(self) -> str:
+        """ Get all metrics in Prometheus text format """
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics.keys())]
+        return ''.join(line + '\n' for metric in metrics for line in metric.render())
+
+    def _get(self, metric_class: Type[M], name: str, description: str, label_names: Sequence[str]) -> M:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if not metric:
+                metric = self._metrics[name] = metric_class(name, description, label_names)
+            elif not isinstance(metric, metric_class) or metric.label_names != tuple(label_names):
+                raise ValueError('Metric "{}" already registered differently!'.format(name))
+            return metric
+
+
+# Registry shared by bot, plugins & utilities
+METRICS = MetricsRegistry()
+
+
+class MetricsServer:
+    """ Http server in background thread, serving metrics on any path """
+    def __init__(self, registry: MetricsRegistry, port: int, host: str = '127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            """ Metrics page on any path """
+            def do_GET(self):   # pylint: disable=C0103
+                """ Handle GET request """
+                body = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):   # pylint: disable=W0221
+                pass
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def port(self) -> int:
+        """ Get bound port (f.e. if given one was 0) """
+        return self._server.server_address[1]
+
+    def close(self):
+        """ Stop serving """
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
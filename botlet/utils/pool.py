@@ -0,0 +1,52 @@
+""" Convenience thread pools """
+from logging import getLogger
+from threading import Event as ThreadEvent, Thread
+from typing import Callable, Generic, Hashable, List, Optional, TypeVar
+
+from .queue import OverflowPolicy, SafeQueue
+
+
+# Any type variable for following generics
+T = TypeVar('T')    # pylint: disable=C0103
+
+
+class ShardedPool(Generic[T]):
+    """ Threads processing items in parallel, keeping order of items with same shard key """
+    def __init__(self, size: int, maxsize: int = 256, overflow: OverflowPolicy = OverflowPolicy.DROP_NEWEST, put_timeout: Optional[float] = None,
+                 key: Optional[Callable[[T], Hashable]] = None):
+        self._queues = [SafeQueue[T](maxsize, overflow, put_timeout, key) for _ in range(max(size, 1))]
+        self._threads: List[Thread] = []
+        self._stopped = ThreadEvent()
+        self._log = getLogger(__name__)
+
+    def start(self, process: Callable[[T], None]):
+        """ Start threads to process queued items """
+        def run(queue: SafeQueue[T]):
+            while not self._stopped.is_set():
+                for item in queue.get_batch(64, 1):
+                    try:
+                        process(item)
+                    except Exception:   # pylint: disable=W0703
+                        self._log.exception('Processing failed! Item: %s', item)
+        self._threads = [Thread(target=run, args=(queue,), daemon=True) for queue in self._queues]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self, timeout: Optional[float] = 30):
+        """ Stop threads """
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def put(self, key: Hashable, item: T) -> bool:
+        """ Puts an item into queue of key shard, return True on success or False on item dropped """
+        return self._queues[hash(key) % len(self._queues)].put(item)
+
+    @property
+    def dropped(self) -> int:
+        """ Get number of items dropped by overflow of all shards """
+        return sum(queue.dropped for queue in self._queues)
+
+    def get_depths(self) -> List[int]:
+        """ Get number of queued items per shard """
+        return [len(queue) for queue in self._queues]
@@ -1,28 +1,153 @@
 """ Convenience queues """
-from queue import Empty, Full, Queue
-from typing import Generic, Optional, TypeVar
+from collections import deque
+from enum import Enum
+from threading import Condition, Lock
+from typing import Callable, Deque, Dict, Generic, Hashable, List, NamedTuple, Optional, TypeVar
 
 
 # Any type variable for following generics
 T = TypeVar('T')    # pylint: disable=C0103
 
 
-class SafeQueue(Generic[T]):
-    """ Thread-safe queue simplified and generic """
-    def __init__(self, maxsize: int = 256):
-        self._queue = Queue(maxsize)
+class OverflowPolicy(Enum):
+    """ Handling of items put into full queue """
+    BLOCK = 'block'  # Wait for space until timeout (forever without), then drop newest
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    COALESCE = 'coalesce'    # Replace queued item of same key (always), else drop newest
+
+
+class Watermarks(NamedTuple):
+    """ Queue sizes to report congestion & recovery at, for backpressure by callback """
+    high: int
+    low: int
+    callback: Callable[[bool], None]   # Receives True on reaching high, False on falling back to low watermark
+
+
+class SafeQueue(Generic[T]):  # pylint: disable=R0902 # Flat state, all guarded by one condition
+    """ Thread-safe queue simplified and generic, with overflow policy and watermarks for backpressure (deque guarded by one condition) """
+    def __init__(self, maxsize: int = 256, overflow: OverflowPolicy = OverflowPolicy.DROP_NEWEST, put_timeout: Optional[float] = None,
+                 key: Optional[Callable[[T], Hashable]] = None, watermarks: Optional[Watermarks] = None):
+        if overflow == OverflowPolicy.COALESCE and not key:
+            raise ValueError('Coalescing queue requires key function!')
+        self._maxsize = maxsize # Unlimited if not positive
+        self._overflow = overflow
+        self._put_timeout = put_timeout
+        self._key = key if overflow == OverflowPolicy.COALESCE else None
+        self._watermarks = watermarks
+        self._items: Deque = deque()    # Keys of items if coalescing
+        self._keyed_items: Dict[Hashable, T] = {}
+        self._changed = Condition(Lock())
+        self._waiting_getters = 0   # Notify only waiting side
+        self._waiting_putters = 0
+        self._above_watermark = False
+        self._dropped = 0
+        self._coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    @property
+    def dropped(self) -> int:
+        """ Get number of items dropped by overflow """
+        return self._dropped
+
+    @property
+    def coalesced(self) -> int:
+        """ Get number of items merged into queued ones """
+        return self._coalesced
 
     def get(self, timeout: Optional[float] = None) -> Optional[T]:
         """ Extracts an item from queue if not empty """
-        try:
-            return self._queue.get_nowait() if timeout is None else self._queue.get(timeout=timeout)
-        except Empty:
-            return None
+        with self._changed:
+            if not self._wait_items(timeout):
+                return None
+            item = self._pop()
+            if self._waiting_putters:
+                self._changed.notify_all()
+            watermark = self._check_watermark()
+        self._notify_watermark(watermark)
+        return item
+
+    def get_batch(self, max_items: int, timeout: Optional[float] = None) -> List[T]:
+        """ Extracts up to max_items from queue, waiting for first one until timeout (empty list on none) """
+        with self._changed:
+            if not self._wait_items(timeout):
+                return []
+            items = [self._pop() for _ in range(min(max_items, len(self._items)))]
+            if self._waiting_putters:
+                self._changed.notify_all()
+            watermark = self._check_watermark()
+        self._notify_watermark(watermark)
+        return items
 
     def put(self, item: T) -> bool:
-        """ Puts an item into queue, return True on success or False on already full """
+        """ Puts an item into queue, return True on success (or coalescing) or False on item dropped """
+        with self._changed:
+            success = self._put(item)
+            watermark = self._check_watermark()
+        self._notify_watermark(watermark)
+        return success
+
+    def _put(self, item: T) -> bool:
+        key = None
+        if self._key:
+            key = self._key(item)
+            if key in self._keyed_items:
+                self._keyed_items[key] = item
+                self._coalesced += 1
+                return True
+        if self._is_full():
+            if self._overflow == OverflowPolicy.DROP_OLDEST:
+                self._pop()
+                self._dropped += 1
+            elif self._overflow != OverflowPolicy.BLOCK or not self._wait_space():
+                self._dropped += 1
+                return False
+        if self._key:
+            self._keyed_items[key] = item
+            self._items.append(key)
+        else:
+            self._items.append(item)
+        if self._waiting_getters:
+            self._changed.notify_all()
+        return True
+
+    def _wait_items(self, timeout: Optional[float]) -> bool:
+        if self._items or timeout is None:
+            return bool(self._items)
+        self._waiting_getters += 1
+        try:
+            return bool(self._changed.wait_for(lambda: self._items, timeout))
+        finally:
+            self._waiting_getters -= 1
+
+    def _wait_space(self) -> bool:
+        self._waiting_putters += 1
         try:
-            self._queue.put_nowait(item)
-            return True
-        except Full:
-            return False
+            return self._changed.wait_for(lambda: not self._is_full(), self._put_timeout)
+        finally:
+            self._waiting_putters -= 1
+
+    def _pop(self) -> T:
+        item = self._items.popleft()
+        return self._keyed_items.pop(item) if self._key else item
+
+    def _is_full(self) -> bool:
+        return 0 < self._maxsize <= len(self._items)
+
+    def _check_watermark(self) -> Optional[bool]:
+        # Report crossing of watermarks once
+        if self._watermarks and self._watermarks.high > 0:
+            if not self._above_watermark and len(self._items) >= self._watermarks.high:
+                self._above_watermark = True
+                return True
+            if self._above_watermark and len(self._items) <= self._watermarks.low:
+                self._above_watermark = False
+                return False
+        return None
+
+    def _notify_watermark(self, watermark: Optional[bool]):
+        # Outside of lock, so callback can use queue
+        if watermark is not None:
+            self._watermarks.callback(watermark)
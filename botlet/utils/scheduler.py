@@ -0,0 +1,161 @@
+""" Convenience scheduling of timed callbacks """
+from datetime import datetime, timedelta
+from heapq import heappop, heappush
+from itertools import count
+from logging import getLogger
+from math import ceil
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, FrozenSet, List, Optional, Tuple
+
+
+class CronSchedule:
+    """ Wall-clock times by cron expression: minute hour day month weekday (f.e. `0 8 * * 1-5`) """
+    _FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))   # Weekday 0 & 7 are sunday
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != len(self._FIELD_RANGES):
+            raise ValueError('Cron expression "{}" requires {} fields!'.format(expression, len(self._FIELD_RANGES)))
+        self._minutes, self._hours, self._days, self._months, weekdays = (
+            _parse_cron_field(field, low, high) for field, (low, high) in zip(fields, self._FIELD_RANGES)
+        )
+        self._weekdays = frozenset(weekday % 7 for weekday in weekdays)
+        # Like cron: restricted day & weekday match either one
+        self._days_restricted = fields[2] != '*'
+        self._weekdays_restricted = fields[4] != '*'
+
+    def get_next(self, after: datetime) -> datetime:
+        """ Get first matching minute after given time """
+        time = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(366 * 24 * 60):  # Walks by days & hours, so about a year of minutes is more than enough
+            if time.month not in self._months or not self._matches_day(time):
+                time = time.replace(hour=0, minute=0) + timedelta(days=1)
+            elif time.hour not in self._hours:
+                time = time.replace(minute=0) + timedelta(hours=1)
+            elif time.minute not in self._minutes:
+                time += timedelta(minutes=1)
+            else:
+                return time
+        raise ValueError('Cron expression never matches!')
+
+    def _matches_day(self, time: datetime) -> bool:
+        day_match = time.day in self._days
+        weekday_match = (time.weekday() + 1) % 7 in self._weekdays
+        if self._days_restricted and self._weekdays_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+
+def _parse_cron_field(field: str, low: int, high: int) -> FrozenSet[int]:
+    # Comma-separated values, ranges & steps
+    values = set()
+    for part in field.split(','):
+        value_range, _, step = part.partition('/')
+        try:
+            if value_range == '*':
+                start, end = low, high
+            elif '-' in value_range:
+                start, end = map(int, value_range.split('-', 1))
+            else:
+                start = end = int(value_range)
+            step_size = int(step) if step else 1
+        except ValueError:
+            raise ValueError('Invalid cron field "{}"!'.format(field)) from None
+        if not low <= start <= end <= high or step_size < 1:
+            raise ValueError('Cron field "{}" out of range {}-{}!'.format(field, low, high))
+        values.update(range(start, end + 1, step_size))
+    return frozenset(values)
+
+
+class ScheduledJob:
+    """ Handle of callback in scheduler """
+    def __init__(self, callback: Callable[[], None], get_next_due: Callable[[float], Optional[float]]):
+        self.callback = callback
+        self.get_next_due = get_next_due  # Receives last due (monotonic), returns next one or None on end
+        self.cancelled = False
+
+    def cancel(self):
+        """ Stop future calls """
+        self.cancelled = True
+
+
+class Scheduler:
+    """ One thread calling back jobs by heap of due times (monotonic, intervals don't drift by callback runtime) """
+    def __init__(self, thread_name: str = 'scheduler'):
+        self._thread_name = thread_name
+        self._jobs: List[Tuple[float, int, ScheduledJob]] = []
+        self._sequence = count()    # Keeps order of same due times
+        self._changed = Condition()
+        self._thread: Optional[Thread] = None   # Started by first job
+        self._closed = False
+        self._log = getLogger(__name__)
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def every(self, interval: float, callback: Callable[[], None], delay: Optional[float] = None) -> ScheduledJob:
+        """ Call back in fixed interval (first after delay, default interval), skipping calls missed by overload """
+        if interval <= 0:
+            raise ValueError('Interval has to be positive!')
+        def get_next_due(due: float) -> float:
+            return due + interval * max(ceil((monotonic() - due) / interval), 1)
+        job = ScheduledJob(callback, get_next_due)
+        self._push(monotonic() + (interval if delay is None else delay), job)
+        return job
+
+    def cron(self, schedule: CronSchedule, callback: Callable[[], None]) -> ScheduledJob:
+        """ Call back at wall-clock times of schedule """
+        planned = [datetime.min]
+        def get_due() -> float:
+            # After last planned time too, in case clocks diverged
+            now = datetime.now()
+            planned[0] = schedule.get_next(max(now, planned[0]))
+            return monotonic() + (planned[0] - now).total_seconds()
+        job = ScheduledJob(callback, lambda _due: get_due())
+        self._push(get_due(), job)
+        return job
+
+    def close(self):
+        """ Stop thread, dropping all jobs """
+        with self._changed:
+            self._closed = True
+            self._jobs.clear()
+            self._changed.notify_all()
+        if self._thread:
+            self._thread.join(30)
+
+    def _push(self, due: float, job: ScheduledJob):
+        with self._changed:
+            if self._closed:
+                raise RuntimeError('Scheduler already closed!')
+            heappush(self._jobs, (due, next(self._sequence), job))
+            if not self._thread:
+                self._thread = Thread(target=self._run, name=self._thread_name, daemon=True)
+                self._thread.start()
+            elif self._jobs[0][2] is job:
+                self._changed.notify_all()  # Earlier than awaited one
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._closed and (not self._jobs or self._jobs[0][0] > monotonic()):
+                    self._changed.wait(self._jobs[0][0] - monotonic() if self._jobs else None)
+                if self._closed:
+                    return
+                due, _, job = heappop(self._jobs)
+            if job.cancelled:
+                continue
+            try:
+                job.callback()
+            except Exception:   # pylint: disable=W0703
+                self._log.exception('Scheduled callback failed!')
+            next_due = job.get_next_due(due)
+            if next_due is not None and not job.cancelled:
+                with self._changed:
+                    if not self._closed:
+                        heappush(self._jobs, (next_due, next(self._sequence), job))
+
+
+# Scheduler shared by plugins
+SCHEDULER = Scheduler('botlet_scheduler')
@@ -5,14 +5,20 @@ from tempfile import TemporaryDirectory
 from shutil import rmtree
 
 
+def safe_rmtree(path: str):
+    """ Like rmtree but with deletion of read-only files (windows) """
+    # See <https://docs.python.org/3/library/shutil.html#rmtree-example>
+    def remove_readonly(func, path, _):
+        chmod(path, S_IWRITE)
+        func(path)
+    rmtree(path, onerror=remove_readonly)
+
+
 class SafeTemporaryDirectory(TemporaryDirectory):
     """ Like TemporaryDirectory but with safe deletion on windows """
     def cleanup(self):
         try:
             super().cleanup()
         except PermissionError:
-            # Windows fix, see <https://docs.python.org/3/library/shutil.html#rmtree-example>
-            def remove_readonly(func, path, _):
-                chmod(path, S_IWRITE)
-                func(path)
-            rmtree(self.name, onerror=remove_readonly)
+            # Windows fix
+            safe_rmtree(self.name)
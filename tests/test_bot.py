@@ -1,10 +1,15 @@
 """ Test bot running """
+from asyncio import run as async_run
+from pkgutil import iter_modules
 from threading import Event, Thread
 from time import sleep
 from timeit import timeit
 from unittest import TestCase
 
-from botlet.bot import run as bot_run
+from botlet.bot import run as bot_run, run_async as bot_run_async, _EventRouter, _get_coalesce_key
+from botlet import plugins
+from botlet.plugins import PLUGIN_MODULES, AbstractPlugin, ChatCommandEventData, ChatOutputEventData, Command, CommandRegistry, Event as PluginEvent, PluginModule, StatusEventData
+from botlet.utils import METRICS, OverflowPolicy, SafeQueue
 
 
 class TestBot(TestCase):
@@ -15,9 +20,33 @@ class TestBot(TestCase):
         stop_event.set()
         self.assertLessEqual(
             timeit(lambda: bot_run({}, {}, stop_event), number=100),
-            3.0,    # Loading plugins by dynamic import takes time
+            3.0,    # Loading configured plugins by import takes time
             'Bot dry run should not take more than 3 seconds!'
         )
+        for event_workers in ('0', '2'):
+            bot_run({'general': {'event_overflow': 'coalesce', 'event_workers': event_workers}}, {}, stop_event)
+        self.assertRaises(ValueError, bot_run, {'general': {'event_overflow': 'block'}}, {}, stop_event)
+
+    def test_coalesce_events(self):
+        """ Only status events get replaced by newer ones """
+        queue = SafeQueue[PluginEvent](8, OverflowPolicy.COALESCE, key=_get_coalesce_key)
+        for event in (
+                PluginEvent('chat', ChatCommandEventData('git rust master', 42)),
+                PluginEvent('chat', ChatCommandEventData('anime_birthdays', 42)),
+                PluginEvent('git', ChatOutputEventData('Commits: foo', 'chat', 42)),
+                PluginEvent('git', ChatOutputEventData('Usage: git', 'chat', 42)),
+                PluginEvent('heartbeat', StatusEventData('first')),
+                PluginEvent('heartbeat', StatusEventData('second'))
+        ):
+            self.assertTrue(queue.put(event))
+        self.assertListEqual(
+            [event.data for event in iter(queue.get, None)],
+            [
+                ChatCommandEventData('git rust master', 42), ChatCommandEventData('anime_birthdays', 42),
+                ChatOutputEventData('Commits: foo', 'chat', 42), ChatOutputEventData('Usage: git', 'chat', 42),
+                StatusEventData('second')
+            ]
+        )
 
     def test_logging_heartbeat_run(self):
         """ Run with logging and heartbeat plugin """
@@ -40,3 +69,89 @@ class TestBot(TestCase):
             stop_event.set()
             thread.join(5)
         self.assertIn('WARNING:Test:Event(publisher=\'heartbeat\', data=StatusEventData(status=\'Test alive.\'))', context_manager.output)
+
+    def test_event_workers_run(self):
+        """ Run with heartbeat plugin and sharded event processing """
+        with self.assertLogs('Test', level='WARNING') as context_manager:
+            stop_event = Event()
+            thread = Thread(
+                target=bot_run,
+                args=[
+                    {
+                        'general': {'identity': 'Test', 'event_workers': '2', 'event_queue_size': '8'},
+                        'plugin.logging': {'level': 'WARNING'},
+                        'plugin.heartbeat': {'interval': '0.5', 'message': 'Test alive.'}
+                    },
+                    {},
+                    stop_event
+                ]
+            )
+            thread.start()
+            sleep(1.2)
+            stop_event.set()
+            thread.join(5)
+        self.assertIn('WARNING:Test:Event(publisher=\'heartbeat\', data=StatusEventData(status=\'Test alive.\'))', context_manager.output)
+        # Queues of stopped bot aren't tracked anymore
+        self.assertNotIn('queue="bot', METRICS.render())
+
+    def test_async_run(self):
+        """ Run with logging and heartbeat plugin on shared event loop """
+        with self.assertLogs('Test', level='WARNING') as context_manager:
+            stop_event = Event()
+            thread = Thread(
+                target=lambda: async_run(bot_run_async(
+                    {
+                        'general': {'identity': 'Test', 'runtime': 'async'},
+                        'plugin.logging': {'level': 'WARNING'},
+                        'plugin.heartbeat': {'interval': '0.5', 'message': 'Test alive.'}
+                    },
+                    {},
+                    stop_event
+                ))
+            )
+            thread.start()
+            sleep(1.2)
+            stop_event.set()
+            thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIn('WARNING:Test:Event(publisher=\'heartbeat\', data=StatusEventData(status=\'Test alive.\'))', context_manager.output)
+
+    def test_event_routing(self):
+        """ Route events to interested workers only """
+        class TestPlugin(AbstractPlugin):
+            """ Plugin collecting applied events """
+            def __init__(self, name, event_data_types):
+                super().__init__(name)
+                self.EVENT_DATA_TYPES = event_data_types   # pylint: disable=C0103
+                self.events = []
+            def apply_event(self, event):
+                self.events.append(event)
+            def get_commands(self):
+                return [Command(self.name, lambda event, _args: self.events.append(event))]
+        all_worker = TestPlugin('all', None)
+        output_worker = TestPlugin('output', (ChatOutputEventData,))
+        command_worker = TestPlugin('command', ())
+        router = _EventRouter([all_worker, output_worker, command_worker], CommandRegistry())
+        events = [
+            PluginEvent('chat', ChatCommandEventData('command', 1)),
+            PluginEvent('chat', ChatCommandEventData('bar command', 1)),
+            PluginEvent('command', ChatOutputEventData('Foo', 'chat', 1)),
+            PluginEvent('all', StatusEventData('Alive'))
+        ]
+        for event in events:
+            router.dispatch(event)
+        self.assertListEqual(all_worker.events, events[:3])
+        self.assertListEqual(output_worker.events, events[2:3])
+        self.assertListEqual(command_worker.events, events[:1])
+
+    def test_plugin_manifest(self):
+        """ Declare all plugin modules & activate by configuration """
+        self.assertSetEqual(
+            {plugin_module.name for plugin_module in PLUGIN_MODULES},
+            {plugins.__name__ + '.' + module_info.name for module_info in iter_modules(plugins.__path__)}
+        )
+        plugin_module = PluginModule('foo', ('plugin.foo',), ('FOO_TOKEN',))
+        self.assertFalse(plugin_module.is_configured({}, {'FOO_TOKEN': ''}))
+        self.assertTrue(plugin_module.is_configured({'plugin.foo': {}}, {}))
+        self.assertTrue(plugin_module.is_configured({}, {'FOO_TOKEN': 'bar'}))
+        self.assertTrue(PluginModule('foo').is_configured({}, {}))
@@ -1,10 +1,26 @@
 """ Test plugins functionaliy"""
-from datetime import date
+from asyncio import run as async_run, sleep as async_sleep, wait_for
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dump as json_dump
+from os import environ, getpid, kill, listdir, symlink
+from os.path import join as path_join
+from subprocess import run as process_run
+from threading import Event as ThreadEvent, Thread, Timer
+from time import sleep, time
+from typing import List, Optional
 from unittest import TestCase
+from urllib.error import HTTPError
 
-from botlet.plugins.chat import _CHAT_COMMAND_ONLY_HINT, _CHAT_COMMAND_PREFIX, _DiscordClient, _SlackClient
-from botlet.plugins.git import _get_repository_branches, _get_repository_branch_commits
-from botlet.plugins.webcrawl import _get_anisearch_birthday_characters
+from botlet.utils import BoundedExecutor, CronSchedule, HttpFetcher, LoadingCache, OverflowPolicy, SafeTemporaryDirectory
+from botlet.plugins import ChatCommandEventData, ChatOutputEventData, Command, CommandRegistry, Event
+from botlet.plugins.chat import _CHAT_COMMAND_ONLY_HINT, _CHAT_COMMAND_PREFIX, _DiscordClient, _Message, _MessageQueue, _MessageSender, _SendLimits, _SlackClient
+from botlet.plugins.git import _format_relative_time, _get_repository_branches, _GitBackend, _GitFanOut, _GitMirrors, _GitWatcher, GitPlugin
+from botlet.plugins.profiling import _PROFILE_SIGNAL, ProfilerPlugin, ProfilerSettings
+from botlet.plugins.timer import CronPlugin
+from botlet.plugins import webcrawl
+from botlet.plugins.webcrawl import _AnisearchBirthdayCharactersParser, _AnisearchCharacter, _AnisearchCharacterAnimeParser, _BirthdayCharactersCache, _CharacterAnimeIndex, \
+    _Crawler, _CrawlSettings, _get_anisearch_birthday_characters, _prefill_anime_index
 
 
 class TestPlugins(TestCase):
@@ -28,6 +44,51 @@ class TestPlugins(TestCase):
             'Slack text unescape has to work!'
         )
 
+    def test_chat_queue(self):
+        """ Chat messages queue awaited on event loop """
+        queue = _MessageQueue(3)
+        self.assertTrue(queue.put(_Message('foo', None)))
+        async def consume():
+            messages = await queue.get_all()
+            # Burst from other thread wakes up once
+            Timer(0.1, lambda: [queue.put(_Message(text, 1)) for text in ('bar', 'baz', 'qux', 'quux')]).start()
+            messages += await wait_for(queue.get_all(), 1)
+            Timer(0.1, queue.close).start()
+            messages += await wait_for(queue.get_all(), 1)
+            return messages
+        self.assertListEqual(
+            [message.text for message in async_run(consume())],
+            ['foo', 'bar', 'baz', 'qux']
+        )
+        queue = _MessageQueue(2, OverflowPolicy.DROP_OLDEST)
+        self.assertListEqual([queue.put(_Message(text, 1)) for text in ('foo', 'bar', 'baz')], [True, True, False])
+        self.assertListEqual([message.text for message in async_run(queue.get_all())], ['bar', 'baz'])
+        self.assertRaises(ValueError, _MessageQueue, 2, OverflowPolicy.BLOCK)
+
+    def test_chat_sender(self):
+        """ Chat messages merged, rate limited and retried """
+        sent = []
+        class RateLimitError(Exception):
+            """ Rate limit response """
+        async def send(channel_id, text):
+            if text == 'limit' and ('limited', channel_id) not in sent:
+                sent.append(('limited', channel_id))
+                raise RateLimitError()
+            sent.append((channel_id, text))
+        sender = _MessageSender(
+            send, lambda text: [text[i:i+10] for i in range(0, len(text), 10)],
+            _SendLimits(10, 100, 2), (RateLimitError,), lambda ex: 0.01
+        )
+        self.assertListEqual(sender.merge_texts(['foo', 'bar', '0123456789ab', 'baz']), ['foo\nbar', '0123456789', 'ab\nbaz'])
+        async def send_all():
+            sender.put_all([(1, 'foo'), (2, 'limit'), (1, 'bar'), (2, 'after')])
+            await async_sleep(0.1)
+            sender.put_all([(1, 'later')])  # Not held up by rate limited channel
+            while len(sent) < 5:
+                await async_sleep(0.01)
+            await sender.close()
+        async_run(wait_for(send_all(), 5))
+        self.assertListEqual(sent, [(1, 'foo\nbar'), ('limited', 2), (1, 'later'), (2, 'limit'), (2, 'after')])
 
     def test_git(self):
         """ Request public git repository """
@@ -38,16 +99,291 @@ class TestPlugins(TestCase):
             _get_repository_branches(repository),
             '"{}" has no branch "{}" anymore?!'.format(repository, branch)
         )
-        self.assertGreater(
-            len(_get_repository_branch_commits(repository, branch).splitlines()),
-            0,
-            '"{}" on branch "{}" should have any commit.'.format(repository, branch)
-        )
+        with SafeTemporaryDirectory(prefix='test_') as dir_path:
+            self.assertGreater(
+                len(_GitMirrors(dir_path, 1024 ** 3).get_branch_commits(repository, branch).splitlines()),
+                0,
+                '"{}" on branch "{}" should have any commit.'.format(repository, branch)
+            )
+
+    def test_git_mirrors(self):
+        """ Request local git repositories by mirrors """
+        with SafeTemporaryDirectory(prefix='test_') as dir_path:
+            repositories = [path_join(dir_path, name) for name in ('foo', 'bar')]
+            for repository in repositories:
+                _create_git_repository(repository, ['First', 'Second', 'Third', 'Fourth'])
+            mirrors = _GitMirrors(path_join(dir_path, 'mirrors'), 1)
+            try:
+                commits = mirrors.get_branch_commits(repositories[0], 'main')
+                self.assertEqual(commits, process_run(
+                    ['git', 'log', '-n3', '--no-decorate', '--format=[%h] %s (by %cn, %cr)', 'main'],
+                    cwd=repositories[0], capture_output=True, text=True, check=True
+                ).stdout.strip())
+                self.assertIn('Fourth', commits.splitlines()[0])
+                self.assertEqual(len(listdir(path_join(dir_path, 'mirrors'))), 1)
+                # Too small cache keeps last used mirror only
+                self.assertIn('Fourth', mirrors.get_branch_commits(repositories[1], 'main'))
+                self.assertEqual(len(listdir(path_join(dir_path, 'mirrors'))), 1)
+                # Long-lived object reader sees fetched commits
+                _create_git_repository(repositories[1], ['Fifth'])
+                self.assertIn('Fifth', mirrors.get_branch_commits(repositories[1], 'main').splitlines()[0])
+                # Mirror vanishing during eviction doesn't fail request
+                symlink(path_join(dir_path, 'missing'), path_join(dir_path, 'mirrors', 'gone.git'))
+                self.assertIn('Fourth', mirrors.get_branch_commits(repositories[0], 'main'))
+            finally:
+                mirrors.close()
+            self.assertEqual(_format_relative_time(int(time()) - 200000), '2 days ago')
+            self.assertEqual(_format_relative_time(int(time()) - 40000000), '1 year, 3 months ago')
+
+    def test_git_watcher(self):
+        """ Poll local git repository & report moved branches """
+        with SafeTemporaryDirectory(prefix='test_') as dir_path:
+            repository = path_join(dir_path, 'foo')
+            _create_git_repository(repository, ['First'])
+            mirrors = _GitMirrors(path_join(dir_path, 'mirrors'), 1024 ** 3)
+            try:
+                watcher = _GitWatcher({'foo': repository}, mirrors, {'main'})
+                self.assertIsNone(watcher.get_branches('foo'))
+                self.assertListEqual(watcher.poll(), [])
+                self.assertListEqual(watcher.get_branches('foo'), ['main'])
+                self.assertEqual(watcher.get_commits('foo', 'main')[0].subject, 'First')
+                self.assertIsNone(watcher.get_commits('foo', 'other'))
+                _create_git_repository(repository, ['Second'])
+                moved = watcher.poll()
+                self.assertListEqual([(name, branch) for name, branch, _commits in moved], [('foo', 'main')])
+                self.assertEqual(moved[0][2][0].subject, 'Second')
+                self.assertListEqual(watcher.poll(), [])
+                # Requested existing branches get watched, missing ones not
+                process_run(['git', 'branch', 'dev'], cwd=repository, check=True)
+                self.assertListEqual(watcher.poll(), [])
+                self.assertIsNone(watcher.get_commits('foo', 'dev'))
+                watcher.poll()
+                self.assertEqual(watcher.get_commits('foo', 'dev')[0].subject, 'Second')
+                self.assertIsNone(watcher.get_commits('foo', 'other'))
+                self.assertListEqual(list(watcher._repositories['foo'].requested), ['dev'])    # pylint: disable=W0212
+            finally:
+                mirrors.close()
+
+    def test_git_fan_out(self):
+        """ Request multiple local git repositories at once """
+        with SafeTemporaryDirectory(prefix='test_') as dir_path:
+            repositories = {name: path_join(dir_path, name) for name in ('foo', 'bar')}
+            for name, repository in repositories.items():
+                _create_git_repository(repository, [name.title()])
+            events: List[Event] = []
+            received = ThreadEvent()
+            plugin = GitPlugin(
+                'git', lambda event: (events.append(event), received.set()), repositories,
+                _GitBackend(
+                    _GitMirrors(path_join(dir_path, 'mirrors'), 1024 ** 3),
+                    LoadingCache[str, List[str]](_get_repository_branches, 60, 0),
+                    BoundedExecutor(2, 1)
+                )
+            )
+            try:
+                git_command = plugin.get_commands()[0]
+                for args in (['*', 'main'], ['bar,foo']):
+                    received.clear()
+                    git_command.handler(Event('chat', ChatCommandEventData('git ' + ' '.join(args), 42)), args)
+                    self.assertTrue(received.wait(10))
+                texts = [event.data.text for event in events]
+                self.assertIn('bar/main:\n', texts[0])
+                self.assertIn('Foo (by Test', texts[0])
+                self.assertListEqual(sorted(texts[1].splitlines()), ['bar: main', 'foo: main'])
+                git_command.handler(Event('chat', ChatCommandEventData('git foo,baz main', 42)), ['foo,baz', 'main'])
+                self.assertEqual(events[-1].data.text, 'Repository not found! baz')
+            finally:
+                plugin.close()
+        # Slow repositories don't hold up others
+        texts = []
+        published = ThreadEvent()
+        with BoundedExecutor(2) as executor:
+            self.assertTrue(_GitFanOut(executor, 0.1).run(
+                {'foo': lambda: 'foo: done' if published.wait(1) else '', 'bar': lambda: 'bar: done'},
+                lambda text: (texts.append(text), published.set())
+            ))
+            self.assertTrue(published.wait(1))
+        self.assertListEqual(texts, ['foo: timed out!\nbar: done'])
 
     def test_anime_birthdays(self):
         """ Fetch birthdays """
         self.assertIn(
             'Miku Hatsune',
-            map(lambda character: character.name, _get_anisearch_birthday_characters(date(2020, 8, 31))),
+            map(lambda character: character.name, async_run(_get_anisearch_birthday_characters(date(2020, 8, 31)))[0]),
             'But Miku has her birthday on 31th August.'
         )
+
+    def test_commands(self):
+        """ Parse & dispatch commands by registry """
+        events = []
+        calls = []
+        registry = CommandRegistry(events.append)
+        registry.register(Command('foo', lambda event, args: calls.append(args), ('BAR', 'BAZ'), 1))
+        registry.register(Command('bar', lambda event, args: calls.append(args)))
+        self.assertRaises(ValueError, registry.register, Command('foo', print))
+        self.assertRaises(ValueError, registry.register, Command('help', print))
+        self.assertEqual(registry.get_help_text(), 'Commands:\nbar\nfoo <BAR> [<BAZ>]')
+        self.assertTrue(registry.dispatch(Event('chat', ChatCommandEventData('foo  1 2', 42))))
+        self.assertTrue(registry.dispatch(Event('chat', ChatCommandEventData('foo', 42))))
+        self.assertTrue(registry.dispatch(Event('chat', ChatCommandEventData('help', 42))))
+        self.assertFalse(registry.dispatch(Event('chat', ChatCommandEventData('baz', 42))))
+        self.assertListEqual(calls, [['1', '2']])
+        self.assertListEqual(events, [
+            Event(CommandRegistry.NAME, ChatOutputEventData('Usage: foo <BAR> [<BAZ>]', 'chat', 42)),
+            Event(CommandRegistry.NAME, ChatOutputEventData(registry.get_help_text(), 'chat', 42))
+        ])
+
+    def test_anisearch_parsers(self):
+        """ Parse pages partially until needed data is complete """
+        parser = _AnisearchBirthdayCharactersParser(31)
+        for chunk in ('<section id="day-30"><a data-title="Character: foo" href="character/1">foo</a></section><sec',
+                      'tion id="day-31"><a data-title="Character: miku hatsune" href="character/2">Miku</a><span>42\u2003❤</span>'):
+            parser.feed(chunk)
+            self.assertFalse(parser.is_complete())
+        parser.feed('</section><section id="day-1">')
+        self.assertTrue(parser.is_complete())
+        self.assertListEqual(parser.get_characters(), [_AnisearchCharacter('Miku Hatsune', None, 42, 'http://www.anisearch.com/character/2')])
+        parser = _AnisearchCharacterAnimeParser()
+        parser.feed('<section><a data-title="Anime: Foo">Foo</a></section>')
+        self.assertTrue(parser.is_complete())
+        self.assertEqual(parser.get_anime(), 'Foo')
+
+    def test_crawler(self):
+        """ Crawl websites with retries on server errors """
+        requests = []
+        class Handler(BaseHTTPRequestHandler):
+            """ Page failing on first request & missing page """
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):   # pylint: disable=C0103
+                """ Handle GET request """
+                requests.append(self.path)
+                status, body = (200, b'<section><a data-title="Anime: Foo">Foo</a></section>') if self.path == '/page' and len(requests) > 1 \
+                    else (503 if self.path == '/page' else 404, b'')
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):   # pylint: disable=W0221
+                pass
+        with ThreadingHTTPServer(('127.0.0.1', 0), Handler) as server:
+            Thread(target=server.serve_forever, daemon=True).start()
+            crawler = _Crawler(HttpFetcher(timeout=5), _CrawlSettings(host_delay=0.01, backoff=0.01))
+            url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+            self.assertEqual(async_run(crawler.crawl(url + 'page', _AnisearchCharacterAnimeParser)).get_anime(), 'Foo')
+            self.assertRaises(HTTPError, async_run, crawler.crawl(url + 'missing', _AnisearchCharacterAnimeParser))
+            server.shutdown()
+        self.assertListEqual(requests, ['/page', '/page', '/missing'])
+
+    def test_anime_index(self):
+        """ Skip pages of known characters by persistent index """
+        requests = []
+        class Handler(BaseHTTPRequestHandler):
+            """ Birthdays page with characters of two days & their pages """
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):   # pylint: disable=C0103
+                """ Handle GET request """
+                requests.append(self.path)
+                body = ('<section id="day-1"><a data-title="Character: foo" href="character/1">Foo</a><span>7\u2003❤</span>'
+                        '<a data-title="Character: bar" href="character/2">Bar</a></section>'
+                        '<section id="day-2"><a data-title="Character: baz" href="character/3">Baz</a></section>') if self.path.startswith('/character/birthdays') \
+                    else '<section><a data-title="Anime: Foo">Foo</a></section>' if self.path == '/character/1' else '<section></section>'
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body.encode('utf-8'))))
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+            def log_message(self, *args):   # pylint: disable=W0221
+                pass
+        class LocalFetcher(HttpFetcher):
+            """ Fetcher redirecting anisearch to local server """
+            def iter_chunks(self, url: str, timeout: Optional[float] = None, chunk_size: int = 16384):
+                return super().iter_chunks(url.replace('http://www.anisearch.com/', local_url), timeout, chunk_size)
+        crawler = webcrawl._CRAWLER    # pylint: disable=W0212
+        with ThreadingHTTPServer(('127.0.0.1', 0), Handler) as server, SafeTemporaryDirectory(prefix='test_') as dir_path:
+            Thread(target=server.serve_forever, daemon=True).start()
+            local_url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+            webcrawl._CRAWLER = _Crawler(LocalFetcher(timeout=5), _CrawlSettings(host_delay=0))  # pylint: disable=W0212
+            try:
+                filepath = path_join(dir_path, 'index.json')
+                expected = ([_AnisearchCharacter('Foo', 'Foo', 7, 'http://www.anisearch.com/character/1')], True)
+                self.assertTupleEqual(async_run(_get_anisearch_birthday_characters(date(2020, 1, 1), _CharacterAnimeIndex(filepath, 1000, 1000))), expected)
+                self.assertEqual(len(requests), 3)
+                # Known anime & non-anime characters from file
+                self.assertTupleEqual(async_run(_get_anisearch_birthday_characters(date(2020, 1, 1), _CharacterAnimeIndex(filepath, 1000, 1000))), expected)
+                self.assertEqual(len(requests), 4)
+                # Prefill crawls unknown characters of all days once
+                index = _CharacterAnimeIndex(filepath, 1000, 1000)
+                async_run(_prefill_anime_index(index, lambda: False))
+                self.assertEqual(len(requests), 4 + 12 + 1)
+                self.assertEqual(len(index), 3)
+                # Expired entries get crawled again
+                self.assertIsNone(_CharacterAnimeIndex(filepath, 1000, -1).get('http://www.anisearch.com/character/2'))
+            finally:
+                webcrawl._CRAWLER = crawler  # pylint: disable=W0212
+                server.shutdown()
+
+    def test_profiler(self):
+        """ Sample stacks of threads by command """
+        events = []
+        stopped = ThreadEvent()
+        with SafeTemporaryDirectory(prefix='test_') as dir_path:
+            profiler = ProfilerPlugin('profiler', events.append, dir_path, {'42'}, ProfilerSettings(0.001, signal_duration=0.1))
+            registry = CommandRegistry()
+            for command in profiler.get_commands():
+                registry.register(command)
+            Thread(target=lambda: stopped.wait(5), name='test_waiter', daemon=True).start()
+            try:
+                registry.dispatch(Event('chat', ChatCommandEventData('profile 0.1', 7)))
+                registry.dispatch(Event('chat', ChatCommandEventData('profile 0.1', 42)))
+                for _ in range(50):
+                    if len(events) > 1:
+                        break
+                    sleep(0.1)
+                # Profile by signal (POSIX only), replying to default channels
+                if _PROFILE_SIGNAL:
+                    sleep(0.1)
+                    kill(getpid(), _PROFILE_SIGNAL)
+                    for _ in range(50):
+                        if len(events) > 2:
+                            break
+                        sleep(0.1)
+                    self.assertEqual(events[2].data.target_publisher, None)
+                    self.assertTrue(events[2].data.text.startswith('Profile of 0.1s'))
+            finally:
+                stopped.set()
+                profiler.close()
+            self.assertEqual(events[0].data, ChatOutputEventData('Profiling is not allowed in this channel!', 'chat', 7))
+            summary = events[1].data.text
+            self.assertTrue(summary.startswith('Profile of 0.1s'))
+            with open(summary.splitlines()[0].rpartition(': ')[2], encoding='utf-8') as file:
+                self.assertTrue(any(line.startswith('test_waiter;') for line in file))
+
+    def test_cron(self):
+        """ Forward replies of timed commands to all chats """
+        events = []
+        plugin = CronPlugin('cron', events.append, {'morning': (CronSchedule('0 8 * * *'), 'git rust master')})
+        try:
+            plugin.apply_event(Event('git', ChatOutputEventData('Commits: foo', 'cron', 'morning')))
+            plugin.apply_event(Event('git', ChatOutputEventData('Commits: bar', 'discord', 42)))
+        finally:
+            plugin.close()
+        self.assertListEqual(events, [Event('cron', ChatOutputEventData('Commits: foo', None, None))])
+
+    def test_anime_birthdays_cache(self):
+        """ Load birthdays from persistent cache """
+        character = _AnisearchCharacter('Miku Hatsune', 'Vocaloid', 42, 'http://www.anisearch.com/character/1')
+        today = date.today()
+        with SafeTemporaryDirectory(prefix='test_') as dir_path:
+            filepath = path_join(dir_path, 'cache.json')
+            with open(filepath, 'w') as file:
+                json_dump({
+                    (today - timedelta(days=1)).isoformat(): [],
+                    today.isoformat(): [character.__dict__]
+                }, file)
+            self.assertListEqual(async_run(_BirthdayCharactersCache(filepath).get(today)), [character])
+
+
+def _create_git_repository(path: str, messages: List[str]):
+    git_env = dict(environ, GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='test@test', GIT_COMMITTER_NAME='Test', GIT_COMMITTER_EMAIL='test@test')
+    process_run(['git', 'init', '-q', '-b', 'main', path], env=git_env, check=True)
+    for message in messages:
+        process_run(['git', 'commit', '-q', '--allow-empty', '-m', message], cwd=path, env=git_env, check=True)
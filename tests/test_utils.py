@@ -1,10 +1,18 @@
 """ Test internal utilities """
+from gzip import compress
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from os import chmod
 from os.path import isdir, isfile
 from stat import S_IREAD
+from threading import Event, Thread, Timer
+from datetime import datetime
+from time import monotonic, sleep
+from typing import Tuple
 from unittest import TestCase
+from urllib.request import urlopen
 
-from botlet.utils import SafeTemporaryDirectory, SafeQueue
+from botlet.utils import BoundedExecutor, CronSchedule, HttpFetcher, LoadingCache, MetricsRegistry, MetricsServer, OverflowPolicy, SafeTemporaryDirectory, SafeQueue, Scheduler, \
+    ShardedPool, TtlCache, Watermarks
 
 class TestUtils(TestCase):
     """ Test suite for utility methods """
@@ -29,3 +37,194 @@ class TestUtils(TestCase):
         self.assertEqual(queue.get(), 1)
         self.assertEqual(queue.get(), 2)
         self.assertIsNone(queue.get())
+        self.assertListEqual(queue.get_batch(2, 0.01), [])
+        for item in range(2):
+            queue.put(item)
+        Timer(0.01, queue.put, (2,)).start()
+        self.assertListEqual(queue.get_batch(5), [0, 1])
+        self.assertListEqual(queue.get_batch(5, 5), [2])
+
+    def test_queue_overflow(self):
+        """ Handle full queue by policies & report watermarks """
+        watermarks = []
+        queue = SafeQueue[int](2, OverflowPolicy.DROP_OLDEST, watermarks=Watermarks(2, 0, watermarks.append))
+        for item in range(3):
+            self.assertTrue(queue.put(item))
+        self.assertListEqual([queue.get(), queue.get()], [1, 2])
+        self.assertListEqual(watermarks, [True, False])
+        self.assertEqual(queue.dropped, 1)
+        queue = SafeQueue[int](1, OverflowPolicy.BLOCK, 0.01)
+        self.assertTrue(queue.put(1))
+        self.assertFalse(queue.put(2))
+        queue = SafeQueue[int](1, OverflowPolicy.BLOCK, 5)
+        self.assertTrue(queue.put(1))
+        Timer(0.01, queue.get).start()
+        self.assertTrue(queue.put(2))
+        self.assertEqual(queue.get(), 2)
+        queue = SafeQueue[Tuple[str, int]](2, OverflowPolicy.COALESCE, key=lambda item: item[0])
+        for item in (('a', 1), ('b', 1), ('a', 2), ('c', 1)):
+            queue.put(item)
+        self.assertListEqual([queue.get(), queue.get(), queue.get()], [('a', 2), ('b', 1), None])
+        self.assertEqual((queue.dropped, queue.coalesced), (1, 1))
+        self.assertRaises(ValueError, SafeQueue, 1, OverflowPolicy.COALESCE)
+
+    def test_pool(self):
+        """ Process items by shards in order """
+        pool = ShardedPool[int](2, 4)
+        self.assertListEqual(pool.get_depths(), [0, 0])
+        for item in range(4):
+            self.assertTrue(pool.put('a', item))
+        self.assertFalse(pool.put('a', 4))
+        self.assertEqual(sum(pool.get_depths()), 4)
+        items = []
+        done = Event()
+        def process(item):
+            items.append(item)
+            if len(items) == 4:
+                done.set()
+        pool.start(process)
+        self.assertTrue(done.wait(5))
+        pool.close()
+        self.assertListEqual(items, [0, 1, 2, 3])
+
+    def test_cache(self):
+        """ Cache entries expire and get evicted """
+        cache = TtlCache[str, int](0.1, 2)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 2)
+        sleep(0.15)
+        self.assertIsNone(cache.get('b'))
+
+    def test_loading_cache(self):
+        """ Cache loads once for concurrent requests and serves stale values """
+        loads = []
+        def load(key):
+            loads.append(key)
+            sleep(0.1)
+            return key * len(loads)
+        cache = LoadingCache[str, str](load, 0.2, 0.5)
+        results = []
+        threads = [Thread(target=lambda: results.append(cache.get('a'))) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(1)
+        self.assertListEqual(results, ['a'] * 3)
+        self.assertListEqual(loads, ['a'])
+        sleep(0.2)
+        self.assertEqual(cache.get('a'), 'a')   # Stale, reloading
+        sleep(0.15)
+        self.assertEqual(cache.get('a'), 'aa')
+        self.assertListEqual(loads, ['a', 'a'])
+
+    def test_executor(self):
+        """ Reject calls beyond workers & queue """
+        executor = BoundedExecutor(1, 1)
+        release = Event()
+        futures = [executor.submit(release.wait) for _ in range(3)]
+        self.assertIsNotNone(futures[0])
+        self.assertIsNotNone(futures[1])
+        self.assertIsNone(futures[2])
+        release.set()
+        futures[1].result(1)
+        sleep(0.1)  # Slots get released after result
+        self.assertIsNotNone(executor.submit(release.wait))
+        executor.shutdown()
+        self.assertRaises(RuntimeError, executor.submit, release.wait)
+        with BoundedExecutor(1) as executor:
+            self.assertEqual(executor.submit(lambda: 1).result(1), 1)
+        self.assertRaises(RuntimeError, executor.submit, release.wait)
+
+    def test_http(self):
+        """ Fetch by keep-alive connection, compressed and revalidated """
+        requests = []
+        class Handler(BaseHTTPRequestHandler):
+            """ Page with entity tag & redirect to it """
+            protocol_version = 'HTTP/1.1'
+            def do_GET(self):   # pylint: disable=C0103
+                """ Handle GET request """
+                requests.append((self.path, self.client_address, self.headers.get('If-None-Match')))
+                if self.path == '/redirect':
+                    self.send_response(302)
+                    self.send_header('Location', '/page')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                elif self.headers.get('If-None-Match') == '"v1"':
+                    self.send_response(304)
+                    self.end_headers()
+                else:
+                    body = compress(b'Hello world!')
+                    self.send_response(200)
+                    self.send_header('ETag', '"v1"')
+                    self.send_header('Content-Encoding', 'gzip')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+            def log_message(self, *args):   # pylint: disable=W0221
+                pass
+        with ThreadingHTTPServer(('127.0.0.1', 0), Handler) as server:
+            Thread(target=server.serve_forever, daemon=True).start()
+            fetcher = HttpFetcher(timeout=5)
+            url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+            self.assertEqual(fetcher.fetch(url + 'redirect'), b'Hello world!')
+            self.assertEqual(fetcher.fetch(url + 'page'), b'Hello world!')
+            fetcher.close()
+            server.shutdown()
+        self.assertListEqual([request[0] for request in requests], ['/redirect', '/page', '/page'])
+        self.assertEqual(len({request[1] for request in requests}), 1, 'Connection should be reused!')
+        self.assertEqual(requests[-1][2], '"v1"')
+
+    def test_metrics(self):
+        """ Collect metrics & serve them in Prometheus text format """
+        registry = MetricsRegistry()
+        registry.counter('foo_total', 'Foo', ('kind',)).inc('a"b')
+        registry.gauge('bar', 'Bar').track(lambda: 42)
+        histogram = registry.histogram('baz_seconds', 'Baz', ('kind',))
+        histogram.observe(0.002, 'x')
+        histogram.labels('x').observe(100)
+        self.assertIs(registry.counter('foo_total', 'Foo', ('kind',)), registry.counter('foo_total', 'Foo', ('kind',)))
+        self.assertRaises(ValueError, registry.gauge, 'foo_total', 'Foo')
+        server = MetricsServer(registry, 0)
+        try:
+            with urlopen('http://127.0.0.1:{}/metrics'.format(server.port), timeout=5) as response:
+                lines = response.read().decode('utf-8').splitlines()
+        finally:
+            server.close()
+        for line in (
+                '# TYPE bar gauge', 'bar 42',
+                '# TYPE baz_seconds histogram', 'baz_seconds_bucket{kind="x",le="0.001"} 0', 'baz_seconds_bucket{kind="x",le="0.0025"} 1',
+                'baz_seconds_bucket{kind="x",le="+Inf"} 2', 'baz_seconds_sum{kind="x"} 100.002', 'baz_seconds_count{kind="x"} 2',
+                '# TYPE foo_total counter', 'foo_total{kind="a\\"b"} 1'
+            ):
+            self.assertIn(line, lines)
+
+    def test_scheduler(self):
+        """ Call back many jobs by one thread without drift """
+        scheduler = Scheduler()
+        calls = {index: [] for index in range(100)}
+        try:
+            start = monotonic()
+            jobs = [scheduler.every(0.05, lambda index=index: calls[index].append(monotonic()), 0) for index in calls]
+            slow_calls = []
+            scheduler.every(0.1, lambda: (slow_calls.append(monotonic()), sleep(0.03)))
+            sleep(0.52)
+            for job in jobs[1:]:
+                job.cancel()
+            sleep(0.2)
+        finally:
+            scheduler.close()
+        self.assertTrue(all(9 <= len(index_calls) <= 12 for index, index_calls in calls.items() if index))
+        self.assertGreater(len(calls[0]), 12)
+        # Runtime of callbacks doesn't delay following ones
+        self.assertAlmostEqual(slow_calls[-1] - start, len(slow_calls) * 0.1, delta=0.05)
+        schedule = CronSchedule('0 8 * * 1-5')
+        self.assertEqual(schedule.get_next(datetime(2026, 10, 16, 8, 0)), datetime(2026, 10, 19, 8, 0))
+        self.assertEqual(CronSchedule('*/15 * 29 2 *').get_next(datetime(2026, 3, 1)), datetime(2028, 2, 29, 0, 0))
+        self.assertEqual(CronSchedule('0 0 1 * 0').get_next(datetime(2026, 10, 16)), datetime(2026, 10, 18))
+        for expression in ('* * * *', '60 * * * *', '*/0 * * * *', 'a * * * *'):
+            self.assertRaises(ValueError, CronSchedule, expression)